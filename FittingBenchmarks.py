@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+###############################################################################
+# FittingBenchmarks.py                                                        #
+# Author: Nicholas Huang                                                      #
+# Benchmarks the FittingTools algorithms on synthetic problems                #
+###############################################################################
+import numpy as np
+import scipy
+import FittingTools as FT
+import materials.basefunctions as bf
+import multiprocessing, resource
+import argparse, json, platform, sys, time, timeit, StringIO
+
+ALGORITHMS = ['lm', 'simplex', 'cg', 'powell', 'BFGS', 'newton', 'l-bfgs-b']
+SIZES = [100, 1000, 10000]
+NOISES = [0.001, 0.01, 0.1]
+
+###############################################################################
+# Problems
+# Each takes the number of points, and returns the function, its Parameters
+# at the starting values, x and the true parameter values.
+
+def linear(n):
+    a, b = FT.Parameter(0.5), FT.Parameter(0.)
+    f = lambda x: a() * x + b()
+    x = np.linspace(0, 10, n)
+    true = np.array([2.5, -1.])
+    return f, [a, b], x, true
+
+def exponential(n):
+    a, tau, c = FT.Parameter(1.), FT.Parameter(1.), FT.Parameter(0.)
+    f = lambda x: a() * np.exp(-x / tau()) + c()
+    x = np.linspace(0, 5, n)
+    true = np.array([2., 0.7, 0.3])
+    return f, [a, tau, c], x, true
+
+def conductivity(n):
+    '''
+    the Jones and Runyan power law of basefunctions.kt
+    '''
+    params = [FT.Parameter(v) for v in (0.05, 1.5, 0.1, 0.5)]
+    alpha, Beta, gamma, power = params
+    f = lambda T: bf.kt(T, alpha(), Beta(), gamma(), power())
+    T = np.logspace(np.log10(0.3), np.log10(300), n)
+    true = np.array([0.0365, 2.11, -0.0216, 0.774])
+    return f, params, T, true
+
+def peaks(n):
+    '''
+    three gaussian peaks on a flat background
+    '''
+    true = np.array([1., 2., 0.3, 0.6, 4.5, 0.5, 0.8, 7., 0.4, 0.1])
+    start = true * (1 + 0.1 * np.array([1, 0.5, 1, -1, 0.2, 1, 1, -0.2,
+                                        -1, 1]))
+    params = [FT.Parameter(v) for v in start]
+    def f(x):
+        y = params[-1]()
+        for i in range(3):
+            height, center, width = params[3 * i:3 * i + 3]
+            y = y + height() * np.exp(-0.5 * ((x - center()) / width()) ** 2)
+        return y
+    x = np.linspace(0, 10, n)
+    return f, params, x, true
+
+PROBLEMS = [('linear', linear), ('exponential', exponential),
+            ('conductivity', conductivity), ('peaks', peaks)]
+
+def makeProblem(generator, n, noise, seed = 0):
+    '''
+    return the function, its Parameters at the starting values, x, y, the
+    errors and the true parameter values, with relative gaussian noise
+    '''
+    rng = np.random.RandomState(seed)
+    function, params, x, true = generator(n)
+    start = np.array([p() for p in params])
+    for p, value in zip(params, true):
+        p.set(value)
+    model = np.array(function(x), dtype = float)
+    errors = noise * np.maximum(np.abs(model), np.mean(np.abs(model)) * 1e-3)
+    y = model + errors * rng.randn(n)
+    for p, value in zip(params, start):
+        p.set(value)
+    return function, params, x, y, errors, true
+
+###############################################################################
+# Running
+
+def _run(conn, generator, n, noise, algorithm, seed):
+    '''
+    run one benchmark in a forked process, and send its record down `conn`
+    '''
+    # poor starting points overflow on purpose
+    np.seterr(all = 'ignore')
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        function, params, x, y, errors, true = makeProblem(generator, n,
+                                                           noise, seed)
+        opts = {}
+        if (algorithm in ('simplex', 'powell', 'cg', 'BFGS', 'newton')):
+            opts['disp'] = 0
+        memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = timeit.default_timer()
+        params, gof = FT.fit(function, params, y, x, errors = errors,
+                             algorithm = algorithm, instrument = True,
+                             **opts)
+        wall = timeit.default_timer() - start
+        memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory
+        values = np.array([p() for p in params])
+        stats = gof['Stats']
+        chi2 = np.sum((gof['residuals'] / errors) ** 2) / (n - len(params))
+        record = {'status': 'ok', 'time': wall,
+                  'model time': stats.modelTime,
+                  'model calls': stats.modelCalls,
+                  'jacobian calls': stats.jacobianCalls,
+                  'cache hits': stats.cacheHits,
+                  'peak memory': memory,
+                  'max relative error': float(np.max(np.abs(values - true) /
+                                                     np.abs(true))),
+                  'reduced chi2': float(chi2),
+                  'values': values.tolist()}
+    except Exception as err:
+        record = {'status': 'error', 'error': repr(err)}
+    record['warnings'] = sys.stdout.getvalue().strip()
+    sys.stdout = stdout
+    conn.send(record)
+    conn.close()
+
+def benchmark(problems = None, algorithms = None, sizes = None, noises = None,
+              repeat = 1, timeout = 60., seed = 0, verbose = True):
+    """
+    Benchmark every algorithm on every problem, size and noise level
+
+    Each fit runs in its own forked process, so that its peak memory can
+    be measured and a fit that does not finish in `timeout` seconds can
+    be stopped.
+
+    Parameters
+    ----------
+    problems : list, optional
+              The names of the problems to run.  Defaults to all of
+              'linear', 'exponential', 'conductivity' and 'peaks'.
+    algorithms : list, optional
+                The algorithms to run, as for `FittingTools.fit`.
+                Defaults to all of them.
+    sizes : list, optional
+           The numbers of points.  Defaults to 100, 1000 and 10000.
+    noises : list, optional
+            The noise levels, relative to the model.  Defaults to 0.001,
+            0.01 and 0.1.
+    repeat : int, optional
+            The number of runs of each benchmark.  The fastest is kept.
+            Defaults to 1.
+    timeout : float, optional
+             The most seconds a fit may take.  Defaults to 60.
+    seed : int, optional
+          Seeds the noise.  Defaults to 0.
+    verbose : bool, optional
+             If true, print each result.  Defaults to True.
+
+    Returns
+    -------
+    results : dict
+             The run information, in 'info', and one record per
+             benchmark, in 'results'.  Each record has the problem, size,
+             noise and algorithm, and a 'status' of 'ok', 'error' or
+             'timeout'.  An 'error' record has the 'error' message, also
+             when the fit process dies.  A record with status 'ok' also
+             has:
+             * 'time': the wall time of the fit, in seconds
+             * 'model time': the time spent in the model, in seconds
+             * 'model calls', 'jacobian calls' and 'cache hits': from
+               the fit's FitStats
+             * 'peak memory': the rise in peak resident memory, in the
+               units of getrusage (kB on linux)
+             * 'max relative error': the largest error of a parameter,
+               relative to its true value
+             * 'reduced chi2': the reduced chi2 of the fit
+             * 'warnings': anything the fit printed
+    """
+
+    generators = dict(PROBLEMS)
+    if (problems is None):
+        problems = [name for name, generator in PROBLEMS]
+    if (algorithms is None):
+        algorithms = ALGORITHMS
+    if (sizes is None):
+        sizes = SIZES
+    if (noises is None):
+        noises = NOISES
+
+    records = []
+    for problem in problems:
+        for n in sizes:
+            for noise in noises:
+                for algorithm in algorithms:
+                    best = None
+                    for i in range(repeat):
+                        record = _runOne(generators[problem], n, noise,
+                                         algorithm, seed, timeout)
+                        if (best is None or (record['status'] == 'ok' and
+                            (best['status'] != 'ok' or
+                             record['time'] < best['time']))):
+                            best = record
+                    best.update({'problem': problem, 'size': n,
+                                 'noise': noise, 'algorithm': algorithm})
+                    records.append(best)
+                    if (verbose):
+                        print _format(best)
+
+    info = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__, 'scipy': scipy.__version__,
+            'platform': platform.platform(), 'repeat': repeat,
+            'timeout': timeout, 'seed': seed}
+    return {'info': info, 'results': records}
+
+def _runOne(generator, n, noise, algorithm, seed, timeout):
+    '''
+    run one benchmark in a forked process, stopping it after `timeout`
+    '''
+    parent, child = multiprocessing.Pipe(duplex = False)
+    process = multiprocessing.Process(target = _run,
+                                      args = (child, generator, n, noise,
+                                              algorithm, seed))
+    process.start()
+    child.close()
+    if (parent.poll(timeout)):
+        try:
+            record = parent.recv()
+        except EOFError:
+            # the process died without sending a record
+            process.join()
+            record = {'status': 'error',
+                      'error': 'the benchmark process exited with code %s'
+                               %process.exitcode}
+    else:
+        process.terminate()
+        record = {'status': 'timeout'}
+    process.join()
+    parent.close()
+    return record
+
+def _format(record):
+    '''
+    one line describing a benchmark record
+    '''
+    name = '%-12s %6d %6g %-9s' %(record['problem'], record['size'],
+                                  record['noise'], record['algorithm'])
+    if (record['status'] != 'ok'):
+        return name + ' ' + record['status']
+    return name + ' %9.4f s %6d calls %6d jac %8.2e err %7.3f chi2' \
+           %(record['time'], record['model calls'], record['jacobian calls'],
+             record['max relative error'], record['reduced chi2'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'Benchmark the FittingTools algorithms')
+    parser.add_argument('-o', '--output', type = str,
+                        default = 'fit_benchmarks.json',
+                        help = 'where to write the results, as json')
+    parser.add_argument('-p', '--problems', nargs = '+',
+                        choices = [name for name, generator in PROBLEMS])
+    parser.add_argument('-a', '--algorithms', nargs = '+',
+                        choices = ALGORITHMS)
+    parser.add_argument('-n', '--sizes', nargs = '+', type = int)
+    parser.add_argument('--noises', nargs = '+', type = float)
+    parser.add_argument('-r', '--repeat', type = int, default = 1)
+    parser.add_argument('-t', '--timeout', type = float, default = 60.)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('-q', '--quick', action = 'store_true',
+                        help = 'only the smallest size and one noise level')
+    args = parser.parse_args()
+    if (args.quick):
+        args.sizes = args.sizes or SIZES[:1]
+        args.noises = args.noises or [0.01]
+    results = benchmark(args.problems, args.algorithms, args.sizes,
+                        args.noises, args.repeat, args.timeout, args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent = 1, sort_keys = True)
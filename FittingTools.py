@@ -4,38 +4,74 @@
 # Provides an easy to use interface for fitting                               #
 ###############################################################################
 import numpy as np
-from scipy import optimize
+from scipy import linalg, optimize, sparse, stats
 import inspect, sys
+import collections
+import timeit
+import multiprocessing
+import threading, select, traceback
 
-class Parameter:
+# the square root of the machine precision, the usual finite difference step
+_EPSILON = np.sqrt(np.finfo(float).eps)
+
+class Parameter(object):
     """
     Helper class to provide easy fitting.  Calling the object will return
     its value.
 
+    The value is stored as an element of a numpy array.  A
+    ParameterVector binds several Parameters to one shared array, so that
+    all of them can be set at once.
+
     Parameters
     ----------
     value : number
            The parameter value
+    derivative : callable, optional
+                The derivative of the fit function with respect to this
+                parameter.  It takes the same arguments as the fit function.
+                If it is None, `fit` estimates it by finite differences.
 
     Attributes
     ----------
     value : number
            The parameter value
+    derivative : callable
+                The derivative of the fit function, or None
     interval : array-like, optional
               The confidence interval.  This, in general, should not be
               set by the user
 
     """
-    
-    def __init__(self, value):
-        self.value = value
+
+    # the ParameterVector that last bound this Parameter
+    _vector = None
+
+    def __init__(self, value, derivative = None):
+        self._bind(np.array([value], dtype = float), 0)
+        self.derivative = derivative
         self.setVariance(0)
+
+    def _bind(self, values, index):
+        '''
+        store the value as element `index` of the array `values`
+        '''
+        self._values = values
+        self._index = index
+
+    @property
+    def value(self):
+        return self._values[self._index]
+
+    @value.setter
+    def value(self, value):
+        self._values[self._index] = value
         
     def set(self, value):
         '''
         set the parameter value
         '''
-        self.value = value
+        self._values[self._index] = value
 
     def setConfInt(self, interval):
         '''
@@ -72,7 +108,7 @@ class Parameter:
         return self.interval
 
     def __call__(self):
-        return self.value
+        return self._values[self._index]
 
     def __str__(self):
         if (self.sigma >= 0):
@@ -81,11 +117,331 @@ class Parameter:
 
     def __repr__(self):
         return self.__str__()
-        
+
+class ParameterVector(object):
+    """
+    A set of Parameters whose values are views into one shared numpy
+    array.  Calling the object will return that array, so a model can
+    read every parameter at once, and `set` writes them all with a single
+    slice assignment.  A ParameterVector can be passed to `fit` in place
+    of a list of Parameters.
+
+    Parameters
+    ----------
+    params : iterable
+            The Parameters to bind.  Their current values are copied into
+            the shared array.  A Parameter should only belong to one
+            ParameterVector at a time.
+
+    Attributes
+    ----------
+    values : array
+            The shared array of parameter values
+
+    Examples
+    --------
+    >>> a, b = FT.Parameter(1), FT.Parameter(2)
+    >>> p = FT.ParameterVector([a, b])
+    >>> f = lambda x: p()[0] * x + p()[1]
+    >>> p.set([3, 4])
+    >>> a()
+    3.0
+    """
+
+    def __init__(self, params):
+        self.params = list(params)
+        self.values = np.array([p() for p in self.params], dtype = float)
+        for i, p in enumerate(self.params):
+            p._bind(self.values, i)
+            p._vector = self
+
+    def set(self, values):
+        '''
+        set all of the parameter values
+        '''
+        self.values[:] = values
+
+    def __call__(self):
+        return self.values
+
+    def __len__(self):
+        return len(self.params)
+
+    def __iter__(self):
+        return iter(self.params)
+
+    def __getitem__(self, i):
+        return self.params[i]
+
+
+def _owner(param):
+    '''
+    return the ParameterVector that `param` is bound to, or None
+    '''
+    vector = param._vector
+    if (vector is not None and param._values is vector.values):
+        return vector
+    return None
+
+def _nArgs(function):
+    '''
+    return the number of arguments of `function`, not counting self
+    '''
+    argList = inspect.getargspec(function)[0]
+    if ('self' in argList):
+        return len(argList) - 1
+    return len(argList)
+
+def _model(function, args):
+    '''
+    return model, where model() evaluates `function` at `args`, and
+    model(g) evaluates another function of the same arguments
+    '''
+    if (_nArgs(function) > 1):
+        # function of many variables
+        return lambda g = function: g(*args)
+    # function of one variable
+    return lambda g = function: g(args)
+
+def _derivOpts(derivs, fitOpts, *names):
+    '''
+    return a copy of `fitOpts` with the entries `names` of `derivs` added,
+    unless the user has already given the first of them
+    '''
+    opts = dict(fitOpts)
+    if (names[0] not in opts):
+        for name in names:
+            if (name in derivs):
+                opts[name] = derivs[name]
+    return opts
+
+def _jacobian(model, vector, columns = None):
+    '''
+    return a function of the parameter values that gives the derivatives
+    of `model` with respect to each Parameter of `vector`, or only those
+    numbered in `columns`, with one row per Parameter.  A Parameter's
+    `derivative` is used if it has one, and central differences are used
+    otherwise.
+    '''
+    params = vector.params
+    if (columns is None):
+        columns = range(len(params))
+    columns = list(columns)
+    unknown = [i for i in columns if params[i].derivative is None]
+    nUnknown = len(unknown)
+    step = np.finfo(float).eps ** (1 / 3.)
+    # whether model broadcasts over its parameters; found on the first call
+    state = {'batched': None}
+
+    def perturbed(values, h):
+        '''
+        the model at `values` +- `h` for each unknown parameter
+        '''
+        sets = np.repeat(values[np.newaxis], 2 * nUnknown, axis = 0)
+        for j, i in enumerate(unknown):
+            sets[j, i] += h[j]
+            sets[nUnknown + j, i] -= h[j]
+
+        if (state['batched'] is not False):
+            # bind each Parameter to a column of its perturbed values
+            values = vector.values
+            vector.values = sets.T[:, :, np.newaxis].copy()
+            try:
+                for i, p in enumerate(params):
+                    p._bind(vector.values, i)
+                out = np.asarray(model())
+            except Exception:
+                out = None
+            finally:
+                vector.values = values
+                for i, p in enumerate(params):
+                    p._bind(values, i)
+            if (state['batched'] is None):
+                # check the first difference against two single calls
+                vector.set(sets[0])
+                high = np.asarray(model())
+                vector.set(sets[nUnknown])
+                low = np.asarray(model())
+                state['batched'] = (out is not None and
+                                    out.shape == (len(sets),) + high.shape
+                                    and np.allclose(out[0] - out[nUnknown],
+                                                    high - low, rtol = 1e-3,
+                                                    atol = 0))
+            if (state['batched']):
+                return out
+
+        out = []
+        for s in sets:
+            vector.set(s)
+            out.append(np.asarray(model()))
+        return np.array(out)
+
+    def dModel(values):
+        values = np.array(values, dtype = float)
+        rows = {}
+        if (nUnknown):
+            h = step * np.where(values[unknown] != 0,
+                                np.abs(values[unknown]), 1)
+            # make the steps exactly representable
+            h = (values[unknown] + h) - values[unknown]
+            out = perturbed(values, h)
+            for j, i in enumerate(unknown):
+                rows[i] = (out[j] - out[nUnknown + j]) / (2 * h[j])
+            shape = out.shape[1:]
+        vector.set(values)
+        if (not nUnknown):
+            shape = np.shape(model())
+        for i in columns:
+            if (params[i].derivative is not None):
+                rows[i] = model(params[i].derivative)
+        return np.array([np.broadcast_to(rows[i], shape) for i in columns])
+
+    return dModel
+
+class FitStats(object):
+    """
+    Timing and evaluation counts of one fit.  `fit` returns one in
+    gof['Stats'] when it is called with instrument = True.
+
+    Parameters
+    ----------
+    nParams : int
+             The number of fit parameters
+    traceSize : int, optional
+               The number of model evaluations to keep in `trace`.
+               Defaults to 0.
+
+    Attributes
+    ----------
+    wallTime : float
+              The total time of the fit, in seconds
+    modelTime : float
+               The time spent inside the fit function, including its
+               calls for derivatives, in seconds
+    overheadTime : float
+                  The rest of `wallTime`, spent in the minimization
+                  function and in `fit`
+    modelCalls : int
+                The number of parameter values at which the fit function
+                was evaluated, not counting derivatives
+    cacheHits : int
+               The number of evaluations found in the model cache
+    jacobianCalls : int
+                   The number of times the derivatives were evaluated
+    trace : array
+           The parameter values and chi2 of the last `traceSize` model
+           evaluations, oldest first, with one row per evaluation and
+           chi2 in the last column.
+    """
+
+    def __init__(self, nParams, traceSize = 0):
+        self.wallTime = 0.
+        self.modelTime = 0.
+        self.modelCalls = 0
+        self.cacheHits = 0
+        self.jacobianCalls = 0
+        # a ring buffer of the trace, and the number of rows written
+        self._trace = np.empty((traceSize, nParams + 1))
+        self._nTrace = 0
+
+    @property
+    def overheadTime(self):
+        return self.wallTime - self.modelTime
+
+    @property
+    def trace(self):
+        size = len(self._trace)
+        if (self._nTrace <= size):
+            return self._trace[:self._nTrace].copy()
+        return np.roll(self._trace, -(self._nTrace % size), axis = 0)
+
+    def timed(self, function):
+        '''
+        return `function`, adding the time spent in it to `modelTime`
+        '''
+        def timedFunction(*args):
+            start = timeit.default_timer()
+            try:
+                return function(*args)
+            finally:
+                self.modelTime += timeit.default_timer() - start
+        return timedFunction
+
+    def counted(self, function):
+        '''
+        return `function`, counting its calls in `jacobianCalls`
+        '''
+        def countedFunction(*args):
+            self.jacobianCalls += 1
+            return function(*args)
+        return countedFunction
+
+    def record(self, values, chi2):
+        '''
+        add a row to the trace
+        '''
+        size = len(self._trace)
+        if (size):
+            row = self._trace[self._nTrace % size]
+            row[:-1] = values
+            row[-1] = chi2
+        self._nTrace += 1
+
+    def __str__(self):
+        return ('%.3g s (%.3g s in the model), %d model calls, ' +
+                '%d cache hits, %d jacobian calls') % \
+               (self.wallTime, self.modelTime, self.modelCalls,
+                self.cacheHits, self.jacobianCalls)
+
+    def __repr__(self):
+        return self.__str__()
+
+class _ModelCache(object):
+    '''
+    Evaluates a model at parameter values, and remembers the last `size`
+    results, so that evaluating the same values again is free.  `hits` and
+    `misses` count the evaluations found in and missing from the cache.
+    '''
+
+    def __init__(self, model, vector, size = 8):
+        self.model = model
+        self.vector = vector
+        self.size = size
+        self.results = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # called with the values and the model after each evaluation
+        self.onMiss = None
+
+    def __call__(self, values):
+        '''
+        set the parameters to `values` and return the model.  The result
+        must not be modified.
+        '''
+        values = np.asarray(values, dtype = float)
+        self.vector.set(values)
+        key = values.tobytes()
+        if (key in self.results):
+            # move it to the most recently used end
+            out = self.results.pop(key)
+            self.hits += 1
+        else:
+            # copy, in case the model reuses its output array
+            out = np.array(self.model())
+            self.misses += 1
+            if (self.onMiss is not None):
+                self.onMiss(values, out)
+            if (self.size and len(self.results) >= self.size):
+                self.results.popitem(last = False)
+        if (self.size):
+            self.results[key] = out
+        return out
 
 def fit(function, params, y, args, 
         rawOutput = False, errors = None, weights = None,
-        algorithm = None, **fitOpts):
+        algorithm = None, jacobian = None, confInt = False,
+        cacheSize = 8, instrument = False, traceSize = 0, callback = None,
+        **fitOpts):
     
     """
     Fit a function of an arbitrary number of inputs and one output
@@ -96,9 +452,11 @@ def fit(function, params, y, args,
               the function to fit.  It should NOT be a function
               of the parameters.
     params : iterable
-            A list of Parameters, with their starting values set.
-            The parameter values will be overwritten before each
-            call to `function`.
+            A list of Parameters, or a ParameterVector, with their
+            starting values set.  The parameter values will be overwritten
+            before each call to `function`.  A list is bound to a new
+            ParameterVector, so every parameter is set with one slice
+            assignment.
     y : array-like
        the measured y-values
     args : array-like
@@ -125,6 +483,39 @@ def fit(function, params, y, args,
                * 'BFGS': BFGS method
                * 'newton': Newton-CG method
                * 'l-bfgs-b': L-BFGS-B constrained minimization
+               * 'linear': Linear least squares, for a function that is
+                 linear in its parameters.  It is solved directly, with
+                 each point weighted by 1 / `errors` (or by `weights`),
+                 so 'cov' is the exact covariance when `errors` is set.
+    jacobian : callable, optional
+              The derivatives of `function` with respect to each
+              parameter.  It takes the same arguments as `function` and
+              returns an array with one row per parameter.  If it is None,
+              the `derivative` of each Parameter is used, and the rest are
+              found by central differences.  If it is False, the
+              minimization function estimates the derivatives itself.
+              The derivatives are passed to 'lm', 'cg', 'BFGS', 'newton'
+              and 'l-bfgs-b'.  Defaults to None.
+    confInt : bool, optional
+             If true, the confidence interval of each parameter is found
+             from its likelihood profile with `profile`.  Otherwise it is
+             the best fit +- one standard error.  Defaults to False.
+    cacheSize : int, optional
+               The number of model evaluations to remember.  The
+               minimization functions often evaluate the same parameter
+               values more than once, and these repeats are free.  0
+               turns the cache off.  Defaults to 8.
+    instrument : bool, optional
+                If true, the fit is timed and its evaluations are counted,
+                and a FitStats is returned in gof['Stats'].  Defaults to
+                False.
+    traceSize : int, optional
+               If `instrument` is set, the parameter values and chi2 of
+               the last `traceSize` model evaluations are kept in
+               gof['Stats'].trace.  Defaults to 0.
+    callback : callable, optional
+              Called with the parameter values and chi2 after each new
+              evaluation of `function`.  Defaults to None.
     **fitOpts : dict, optional
                All remaining keyword arguments are passed to the
                minimization function.  If it is not included,
@@ -144,12 +535,22 @@ def fit(function, params, y, args,
          * 'residuals': an array of residuals (`y` - `function`(*`args`))
          * 'Reduced Chi2': the reduced Chi-squared
          * 'RMS error': The total rms errror of the fit
+         * 'cov': the covariance matrix, if the algorithm gives one
+         * 'Model calls': the number of times `function` was evaluated,
+           not counting derivatives
+         * 'Cache hits': the number of evaluations found in the cache
+         * 'Stats': a FitStats, if `instrument` is set
 
     Notes
     -----
     If the minimization algorithm generates a warning flag, a message
     containing warning information will be printed to standard output.
 
+    The central differences are found in one call to `function`, with
+    each Parameter set to a column of every perturbed value, if
+    `function` broadcasts over its parameters.  Otherwise `function` is
+    called once for each perturbed value.
+
     Examples
     --------
     >>> import FittingTools as FT
@@ -166,6 +567,9 @@ def fit(function, params, y, args,
     All minimization routines come from scipy.optimize.
     """
 
+    if (instrument):
+        start = timeit.default_timer()
+
     ##########################################################################
     # Begin error function 
     if errors is not None:
@@ -174,50 +578,96 @@ def fit(function, params, y, args,
     elif weights is None:
         weights = np.ones(np.shape(y))
 
-    argList = inspect.getargspec(function)[0]
-    if ('self' in argList):
-        nArgs = len(argList) - 1
+    if (isinstance(params, ParameterVector)):
+        vector = params
     else:
-        nArgs = len(argList)
+        vector = ParameterVector(params)
+    setParams = vector.set
 
-    if (nArgs > 1):
-        # function of many variables
-        def f(parameters):
-            i = 0
-            for p in params:
-                p.set(parameters[i])
-                i += 1
-            return (y - function(*args)) * weights
+    model = _model(function, args)
+
+    if (instrument):
+        fitStats = FitStats(len(vector), traceSize)
+        model = fitStats.timed(model)
+
+    cache = _ModelCache(model, vector, cacheSize)
+    if ((instrument and traceSize) or callback is not None):
+        def onMiss(values, out):
+            r = out - y
+            if errors is not None:
+                r = r / errors
+            chi2Value = np.sum(r * r)
+            if (instrument and traceSize):
+                fitStats.record(values, chi2Value)
+            if (callback is not None):
+                callback(values, chi2Value)
+        cache.onMiss = onMiss
+    def f(parameters):
+        return (y - cache(parameters)) * weights
+    def chi2(parameters):
+        r = cache(parameters) - y
         if errors is not None:
-            chi2 = lambda p: sum(((function(*args) - y) / errors) ** 2)
-        else:
-            chi2 = lambda p: sum(((function(*args) - y)) ** 2)
+            r = r / errors
+        return np.sum(r * r)
+    # End error function 
+    ##########################################################################
+
+    ##########################################################################
+    # Begin derivatives
+    if (jacobian is False):
+        derivs = {}
     else:
-        # function of one variable
-        def f(parameters):
-            i = 0
-            for p in params:
-                p.set(parameters[i])
-                i += 1
-            return (y - function(args)) * weights
+        if (jacobian is not None):
+            def dModel(parameters):
+                setParams(parameters)
+                return np.asarray(model(jacobian))
+        else:
+            dModel = _jacobian(model, vector)
+        if (instrument):
+            dModel = fitStats.counted(dModel)
         if errors is not None:
-            chi2 = lambda p: sum(((function(args) - y) / errors) ** 2)
+            chiWeights = 1. / (errors * errors)
         else:
-            chi2 = lambda p: sum(((function(args) - y)) ** 2)
-    # End error function 
+            chiWeights = 1.
+        # chi2 = sum(chiWeights * (model - y) ** 2)
+        def grad(parameters):
+            J = dModel(parameters)
+            return 2 * np.dot(J, (cache(parameters) - y) * chiWeights)
+        def hess(parameters):
+            J = dModel(parameters)
+            return 2 * np.dot(J * chiWeights, J.T)
+        derivs = {'Dfun': lambda parameters: -dModel(parameters) * weights,
+                  'col_deriv': True, 'fprime': grad, 'fhess': hess}
+    # End derivatives
     ##########################################################################
 
-    # build a list of parameter values
-    p = [param() for param in params]
+    # the starting parameter values
+    p = vector().copy()
 
     # Now, run the selected minimization algorithm
-    if (algorithm == None or algorithm == 'lm'):
+    if (algorithm == 'linear'):
+        # solve directly, weighting each point by 1 / error
+        if errors is not None:
+            linWeights = 1. / errors
+        else:
+            linWeights = weights
+        offset, design = _design(cache, p)
+        p, cov = _linearSolve(design, (y - offset)[np.newaxis], linWeights)
+        p = p[0]
+        if (rawOutput):
+            return p, cov
+        residuals = y - cache(p)
+        fMin = np.sum((residuals * linWeights) ** 2)
+
+    elif (algorithm == None or algorithm == 'lm'):
         # Use Levenberg-Marquardt
         p, cov, infodict, mesg, flag = \
-           optimize.leastsq(f, p, full_output = True, **fitOpts)
+           optimize.leastsq(f, p, full_output = True,
+                            **_derivOpts(derivs, fitOpts, 'Dfun',
+                                         'col_deriv'))
 
         if (rawOutput):
-            return p, cov, infodict, mesg, ier
+            return p, cov, infodict, mesg, flag
         # print warnings
         if (flag > 4):
             print mesg
@@ -239,7 +689,8 @@ def fit(function, params, y, args,
             
         elif (algorithm == 'cg' or algorithm == 'conjugate'):
             p, fMin, funcCalls, gradCalls, flag =\
-               optimize.fmin_cg(chi2, p, full_output = True, **fitOpts)
+               optimize.fmin_cg(chi2, p, full_output = True,
+                                **_derivOpts(derivs, fitOpts, 'fprime'))
             if (rawOutput):
                 return p, fMin, funcCalls, gradCalls, flag
             # print warnings
@@ -264,7 +715,8 @@ def fit(function, params, y, args,
                 
         elif (algorithm == 'BFGS'):
             p, fMin, grad, Bopt, funcCalls, gradCalls, flag = \
-               optimize.fmin_bfgs(chi2, p, full_output = True, **fitOpts)
+               optimize.fmin_bfgs(chi2, p, full_output = True,
+                                  **_derivOpts(derivs, fitOpts, 'fprime'))
             if (rawOutput):
                 return p, fMin, grad, Bopt, funcCalls, gradCalls, flag
             # print warnings
@@ -275,8 +727,13 @@ def fit(function, params, y, args,
                       'changing'
 
         elif (algorithm == 'newton'):
+            opts = _derivOpts(derivs, fitOpts, 'fprime', 'fhess')
+            if ('fprime' not in opts):
+                # Newton-CG cannot estimate the gradient itself
+                opts['fprime'] = lambda parameters: \
+                    optimize.approx_fprime(parameters, chi2, _EPSILON)
             p, fMin, funcCalls, gradCalls, hessCalls, flag =\
-               optimize.fmin_ncg(chi2, p, full_output == True, **fitOpts)
+               optimize.fmin_ncg(chi2, p, full_output = True, **opts)
             if (rawOutput):
                 return p, fMin, funcCalls, gradCalls, hessCalls, flag
             # print warnings
@@ -285,7 +742,10 @@ def fit(function, params, y, args,
                       'reached.'
                 
         elif (algorithm == 'l-bfgs-b'):
-            p, fMin, infodict = optimize.fmin_l_bfgs_b(chi2, p, **fitOpts)
+            opts = _derivOpts(derivs, fitOpts, 'fprime')
+            if ('fprime' not in opts):
+                opts.setdefault('approx_grad', True)
+            p, fMin, infodict = optimize.fmin_l_bfgs_b(chi2, p, **opts)
             if (rawOutput):
                 return p, fMin, infodict
             flag = infodict['warnflag']
@@ -300,10 +760,8 @@ def fit(function, params, y, args,
 
         residuals = f(p) / weights
 
-    # set confidence intervals for each parameter
-    # This may not work yet.  Needs verification
-    #for param in params:
-        #ConfInt(function, y, args, param, fMin, weights)
+    # leave the parameters at the best fit, not the last evaluation
+    setParams(p)
 
     chi2Reduced = fMin / (len(residuals) - len(params))
     rmsErr = np.sqrt(np.sum(residuals * residuals))
@@ -316,10 +774,1395 @@ def fit(function, params, y, args,
     except NameError:
         gof = {'residuals': residuals, 'Reduced Chi2': chi2Reduced,
                'RMS error': rmsErr}
+    gof['Model calls'] = cache.misses
+    gof['Cache hits'] = cache.hits
+    if (instrument):
+        fitStats.modelCalls = cache.misses
+        fitStats.cacheHits = cache.hits
+        fitStats.wallTime = timeit.default_timer() - start
+        gof['Stats'] = fitStats
+
+    # set confidence intervals for each parameter
+    if (confInt):
+        if (jacobian is False):
+            jacobian = None
+        profile(function, vector, y, args, errors = errors,
+                jacobian = jacobian)
         
     return params, gof
 
+def _linearSolve(A, Y, w):
+    '''
+    solve the weighted linear least squares problem A p = y for each row
+    y of `Y`, sharing one QR factorization of `A`, which has one column
+    per parameter.  `w` weights each point.  Returns the solutions, with
+    one row per row of `Y`, and the covariance (A^T W^2 A)^-1.
+    '''
+    Aw = A * np.asarray(w, dtype = float).reshape(-1, 1)
+    Yw = Y * w
+    Q, R = np.linalg.qr(Aw)
+    diag = np.abs(np.diagonal(R))
+    if (len(diag) and diag.min() > diag.max() * len(Aw) *
+        np.finfo(float).eps):
+        p = linalg.solve_triangular(R, np.dot(Q.T, Yw.T)).T
+        Rinv = linalg.solve_triangular(R, np.eye(len(R)))
+        cov = np.dot(Rinv, Rinv.T)
+    else:
+        # rank deficient: use the minimum norm solution
+        p = np.linalg.lstsq(Aw, Yw.T, rcond = None)[0].T
+        cov = np.linalg.pinv(np.dot(Aw.T, Aw))
+    return p, cov
+
+def _design(model, values):
+    '''
+    return the offset and the design matrix of `model`, a function of the
+    parameter values that is linear in them, so that model(p) = offset +
+    design p.  Warns if `model` is not linear near `values`.
+    '''
+    k = len(values)
+    offset = np.array(model(np.zeros(k)), dtype = float)
+    design = np.empty((len(offset), k))
+    unit = np.zeros(k)
+    for i in range(k):
+        unit[i] = 1
+        design[:, i] = model(unit) - offset
+        unit[i] = 0
+    # check at a point away from the unit vectors
+    test = np.asarray(values, dtype = float) + 0.5
+    if (not np.allclose(model(test), offset + np.dot(design, test),
+                        rtol = 1e-6, atol = 1e-12 * np.max(np.abs(design)))):
+        print 'Linear: Warning: function is not linear in its parameters'
+    return offset, design
+
+def fit_linear(basis, params, y, errors = None, weights = None):
+    """
+    Fit a linear combination of basis functions directly
+
+    Parameters
+    ----------
+    basis : array-like
+           The basis functions evaluated at each point, with one row per
+           parameter, so the model is sum(params[i] * basis[i]).
+    params : iterable
+            A list of Parameters, or a ParameterVector, one per row of
+            `basis`.
+    y : array-like
+       the measured y-values.  If `y` has several rows, each is fit with
+       the same factorization of `basis`.
+    errors : array-like, optional
+            The standard deviation of each point.  Each point is weighted
+            by 1 / `errors`.  Defaults to None.
+    weights : array-like, optional
+             The weight of each point, used if `errors` is None.  Defaults
+             to None.
+
+    Returns
+    -------
+    params : array-like
+            The Parameters with their updated values.  If `y` has several
+            rows, this is instead an array of the values, with one row per
+            row of `y`, and the Parameters are not changed.
+    gof : dict
+         A dictionary containing Goodness of Fit information, as for
+         `fit`.  'cov' is the exact covariance when `errors` is set.  If
+         `y` has several rows, 'residuals', 'Reduced Chi2' and 'RMS
+         error' have one entry per row.
+
+    Examples
+    --------
+    >>> x = np.linspace(0, 1, 100)
+    >>> params = [FT.Parameter(0) for i in range(3)]
+    >>> basis = [np.ones_like(x), x, x * x]
+    >>> FT.fit_linear(basis, params, y)
+    """
+
+    if (isinstance(params, ParameterVector)):
+        params = params.params
+    basis = np.asarray(basis, dtype = float)
+    y = np.asarray(y, dtype = float)
+    Y = np.atleast_2d(y)
+    if errors is not None:
+        w = 1. / np.asarray(errors, dtype = float)
+    elif weights is not None:
+        w = np.asarray(weights, dtype = float)
+    else:
+        w = np.ones(basis.shape[1])
+
+    values, cov = _linearSolve(basis.T, Y, w)
+    residuals = Y - np.dot(values, basis)
+    fMin = np.sum((residuals * w) ** 2, axis = 1)
+    chi2Reduced = fMin / (basis.shape[1] - len(basis))
+    rmsErr = np.sqrt(np.sum(residuals * residuals, axis = 1))
+    if (y.ndim > 1):
+        return values, {'residuals': residuals, 'Reduced Chi2': chi2Reduced,
+                        'RMS error': rmsErr, 'cov': cov}
+
+    for i, p in enumerate(params):
+        p.set(values[0, i])
+        p.setVariance(abs(cov[i][i]))
+    return params, {'residuals': residuals[0],
+                    'Reduced Chi2': chi2Reduced[0], 'RMS error': rmsErr[0],
+                    'cov': cov}
+
+# the worker and its state in a pool worker process.  _setState sets them
+# as each worker starts, from the pool's initargs, which forked workers
+# inherit instead of having to pickle the (usually unpicklable) model
+# closure.  Each pool has its own, so concurrent maps do not interfere.
+_workerState = None
+
+def _setState(worker, state):
+    global _workerState
+    _workerState = (worker, state)
+
+def _runTask(task):
+    worker, state = _workerState
+    return worker(state, task)
+
+def _map(worker, tasks, processes = None, state = None):
+    '''
+    return [worker(state, task) for task in tasks], run in a pool of
+    `processes` forked worker processes.  If `processes` is None, one is
+    used per cpu, and if it is 1, the tasks are run in this process.  They
+    are also run in this process if it is itself a pool worker (e.g. a
+    fit(confInt = True) inside fit_many), since daemonic processes cannot
+    have children.
+    '''
+    if (processes is None):
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(tasks)))
+    if (processes == 1 or multiprocessing.current_process().daemon):
+        return [worker(state, task) for task in tasks]
+    pool = multiprocessing.Pool(processes, initializer = _setState,
+                                initargs = (worker, state))
+    try:
+        return pool.map(_runTask, tasks, chunksize = 1)
+    finally:
+        pool.close()
+        pool.join()
+
+def _fitManyChunk(state, indices):
+    '''
+    fit the datasets in `indices` of a fit_many problem
+    '''
+    function, vector, start, Y, X, errors, algorithm, fitOpts = state
+    out = []
+    for i in indices:
+        vector.set(start)
+        if (isinstance(X, _PerDataset)):
+            args = X[i]
+        else:
+            args = X
+        if (errors is not None and np.ndim(errors) > 1):
+            err = errors[i]
+        else:
+            err = errors
+        gof = fit(function, vector, Y[i], args, errors = err,
+                  algorithm = algorithm, **fitOpts)[1]
+        out.append((i, vector().copy(), gof))
+    return out
+
+class _PerDataset(list):
+    '''
+    marks the `X` of fit_many as one set of args per dataset
+    '''
+    pass
+
+def _vectorizedLM(function, vector, Y, X, errors, nArgs,
+                  maxIter = None, ftol = 1.49012e-8, xtol = 1.49012e-8):
+    '''
+    Levenberg-Marquardt over every dataset at once.  The values of
+    `vector` are replaced by an array of shape (n params, n, 1), so each
+    Parameter is a column and `function` evaluates the model for every
+    dataset in one call.  The caller restores the values.  Returns the
+    values, the covariance matrices, the residuals and the number of fits
+    that did not converge.
+    '''
+    n, m = Y.shape
+    k = len(vector)
+    if maxIter is None:
+        maxIter = 200 * (k + 1)
+
+    if errors is not None:
+        weights = 1. / (errors * errors)
+        weights = weights / np.mean(weights, axis = -1)[..., np.newaxis]
+    else:
+        weights = np.ones(m)
+
+    values = np.empty((k, n, 1))
+    values[:] = vector()[:, np.newaxis, np.newaxis]
+    vector.values = values
+    for i, p in enumerate(vector):
+        p._bind(values, i)
+
+    def f(P):
+        values[:] = P
+        if (nArgs > 1):
+            model = function(*X)
+        else:
+            model = function(X)
+        return (Y - np.broadcast_to(model, Y.shape)) * weights
+
+    eps = np.sqrt(np.finfo(float).eps)
+    def jacobian(P, r):
+        J = np.empty((n, m, k))
+        for j in range(k):
+            h = eps * np.abs(P[j])
+            h[h == 0] = eps
+            Ph = P.copy()
+            Ph[j] += h
+            J[:, :, j] = (f(Ph) - r) / h
+        return J
+
+    P = values.copy()
+    r = f(P)
+    chi = np.sum(r * r, axis = 1)
+    lam = np.full(n, 0.1)
+    active = np.ones(n, dtype = bool)
+    eye = np.eye(k)
+    for iteration in range(maxIter):
+        J = jacobian(P, r)
+        A = np.einsum('nmi,nmj->nij', J, J)
+        g = np.einsum('nmi,nm->ni', J, r)
+        D = np.diagonal(A, axis1 = 1, axis2 = 2).copy()
+        D[D == 0] = 1
+
+        # raise the damping of each fit until its step reduces chi2
+        while True:
+            M = A + (lam[:, np.newaxis] * D)[:, :, np.newaxis] * eye
+            try:
+                step = -np.linalg.solve(M, g[:, :, np.newaxis])[:, :, 0]
+            except np.linalg.LinAlgError:
+                step = -np.einsum('nij,nj->ni', np.linalg.pinv(M), g)
+            step[~active] = 0
+            Pnew = P + step.T[:, :, np.newaxis]
+            rnew = f(Pnew)
+            chiNew = np.sum(rnew * rnew, axis = 1)
+            better = active & (chiNew <= chi)
+            worse = active & ~better
+            lam[worse] *= 10
+            if (not worse.any() or better.any() or
+                (lam[worse] > 1e16).all()):
+                break
+        lam[better] /= 10
+
+        reduction = (chi - chiNew) / np.where(chi > 0, chi, 1)
+        size = np.sqrt(np.sum(step * step, axis = 1))
+        norm = np.sqrt(np.sum(P[:, :, 0] ** 2, axis = 0))
+        P[:, better] = Pnew[:, better]
+        r[better] = rnew[better]
+        chi[better] = chiNew[better]
+        done = better & ((reduction <= ftol) | (size <= xtol * norm))
+        active &= ~(done | (lam > 1e16))
+        if (not active.any()):
+            break
+
+    J = jacobian(P, r)
+    A = np.einsum('nmi,nmj->nij', J, J)
+    cov = np.empty((n, k, k))
+    for i in range(n):
+        try:
+            cov[i] = np.linalg.inv(A[i])
+        except np.linalg.LinAlgError:
+            cov[i] = np.nan
+
+    return P[:, :, 0].T, cov, r / weights, int(np.sum(active))
+
+def fit_many(function, params, Y, X, errors = None, algorithm = None,
+             vectorized = False, processes = None, chunksize = None,
+             **fitOpts):
+    """
+    Fit the same function independently to many datasets
+
+    Parameters
+    ----------
+    function : callable
+              the function to fit, as for `fit`.
+    params : iterable
+            A list of Parameters, or a ParameterVector, with their
+            starting values set.  Every dataset is fit from these
+            starting values.
+    Y : array-like
+       the measured y-values, with shape (n datasets, n points)
+    X : array-like
+       the values at which `Y` was measured, as well as any other inputs
+       to `function`.  These are shared by every dataset, unless `X` is
+       an array with the same shape as `Y`, in which case row i is used
+       for dataset i.
+    errors : array-like, optional
+            The standard deviation of each point, with shape (n points) or
+            (n datasets, n points).  Defaults to None.
+    algorithm : string, optional
+               The minimization algorithm, as for `fit`.  Defaults to 'lm'.
+    vectorized : bool, optional
+                If true, fit every dataset at once with a vectorized
+                Levenberg-Marquardt.  While `function` is evaluated, each
+                Parameter returns an array of shape (n datasets, 1), and
+                a ParameterVector one of shape (n params, n datasets, 1),
+                so `function` must broadcast to an array with the shape
+                of `Y`.  Defaults to False.
+    processes : int, optional
+               The number of worker processes used when `vectorized` is
+               false.  Defaults to the number of cpus.  If 1, the fits are
+               done in this process.
+    chunksize : int, optional
+               The number of datasets sent to a worker at a time.  Defaults
+               to about four chunks per worker.
+    **fitOpts : dict, optional
+               Passed to `fit` for each dataset.  The vectorized fit
+               accepts 'maxIter', 'ftol' and 'xtol'.
+
+    Returns
+    -------
+    values : array
+            The best fit values, with shape (n datasets, n params)
+    cov : array
+         The covariance matrices, with shape (n datasets, n params,
+         n params).  They are NaN where `fit` did not return one.
+    gofs : list
+          The Goodness of Fit dictionary of each dataset, as for `fit`
+
+    Notes
+    -----
+    The Parameters in `params` are left at their starting values.
+
+    The worker processes are forked and inherit `function`, so it does not
+    need to be picklable.  Platforms without fork should use `processes`
+    = 1 or `vectorized`.
+
+    Examples
+    --------
+    >>> a, b = FT.Parameter(1), FT.Parameter(0)
+    >>> f = lambda x: a() * x + b()
+    >>> x = np.arange(10.)
+    >>> Y = np.random.random((1000, 1)) * x + np.random.random((1000, 1))
+    >>> values, cov, gofs = FT.fit_many(f, [a, b], Y, x, vectorized = True)
+    """
+
+    # fit into the caller's ParameterVector, so that a model reading it
+    # sees the trial values.  Parameters given in a list are bound to a
+    # new one, and bound back when done.
+    if (isinstance(params, ParameterVector)):
+        vector = params
+        bindings = [(vector.values, i) for i in range(len(vector))]
+    else:
+        params = list(params)
+        bindings = [(p._values, p._index) for p in params]
+        vector = ParameterVector(params)
+    params = vector.params
+    array = vector.values
+    start = vector().copy()
+    Y = np.asarray(Y, dtype = float)
+    if (Y.ndim == 1):
+        Y = Y[np.newaxis]
+    n = len(Y)
+    k = len(params)
+    if errors is not None:
+        errors = np.asarray(errors, dtype = float)
+
+    try:
+        if (vectorized):
+            if (algorithm not in (None, 'lm')):
+                raise ValueError('fit_many: the vectorized fit only ' +
+                                 'supports Levenberg-Marquardt')
+            if errors is not None:
+                errors = np.broadcast_to(errors, Y.shape)
+            values, cov, residuals, failed = \
+                _vectorizedLM(function, vector, Y, X, errors,
+                              _nArgs(function), **fitOpts)
+            if (failed):
+                print 'fit_many: Warning: %d fits did not converge' %failed
+            gofs = []
+            for i in range(n):
+                fMin = np.sum(residuals[i] * residuals[i])
+                gofs.append({'residuals': residuals[i],
+                             'Reduced Chi2': fMin / (Y.shape[1] - k),
+                             'RMS error': np.sqrt(fMin), 'cov': cov[i]})
+            return values, cov, gofs
+
+        if (np.shape(X) == Y.shape):
+            X = _PerDataset(np.asarray(X))
+        if (processes is None):
+            processes = multiprocessing.cpu_count()
+        processes = max(1, min(processes, n))
+        if (chunksize is None):
+            chunksize = max(1, int(np.ceil(n / (4. * processes))))
+        chunks = [range(i, min(i + chunksize, n))
+                  for i in range(0, n, chunksize)]
+
+        results = _map(_fitManyChunk, chunks, processes,
+                       (function, vector, start, Y, X, errors, algorithm,
+                        fitOpts))
+    finally:
+        vector.values = array
+        for p, (values, index), value in zip(params, bindings, start):
+            p._bind(values, index)
+            p.set(value)
+
+    values = np.empty((n, k))
+    cov = np.empty((n, k, k))
+    gofs = [None] * n
+    for chunk in results:
+        for i, value, gof in chunk:
+            values[i] = value
+            if (gof.get('cov') is not None):
+                cov[i] = gof['cov']
+            else:
+                cov[i] = np.nan
+            gofs[i] = gof
+    return values, cov, gofs
+
+def fit_joint(datasets, rawOutput = False, **fitOpts):
+    """
+    Fit several datasets at once, with Parameters shared between them
+
+    Parameters
+    ----------
+    datasets : list
+              One (function, params, y, args) or (function, params, y,
+              args, errors) tuple for each dataset, with the same meaning
+              as for `fit`.  `params` lists every Parameter that
+              `function` uses.  A Parameter listed for several datasets
+              is shared by them, and the others are local to one dataset.
+              `params` may instead be a ParameterVector, or a list of some
+              of its Parameters, as long as every Parameter belongs to
+              the same ParameterVector.  The trial values are then
+              written into that vector, so `function` may read it.
+    rawOutput : bool, optional
+               If true, fit_joint returns the output of
+               optimize.least_squares.  Defaults to False
+    **fitOpts : dict, optional
+               All remaining keyword arguments are passed to
+               optimize.least_squares.
+
+    Returns
+    -------
+    If `rawOutput` is set, this function returns the same thing as
+    optimize.least_squares.
+    Otherwise, it returns
+    params : list
+            Every Parameter, in the order they first appear in `datasets`,
+            or in the order of their ParameterVector
+    gof : dict
+         A dictionary containing Goodness of Fit information:
+         * 'residuals': a list of the residuals of each dataset
+         * 'Reduced Chi2': the reduced Chi-squared of the joint fit
+         * 'RMS error': The total rms errror of the fit
+         * 'cov': the covariance matrix of `params`
+
+    Notes
+    -----
+    Each dataset's residuals depend only on its own Parameters, so the
+    Jacobian is block-sparse.  It is built as a scipy.sparse matrix with
+    a fixed sparsity pattern, the derivatives of each dataset are found
+    only for its own Parameters (as for `fit`), and least_squares solves
+    the trust region problems with lsmr.  The residuals of each dataset
+    are written into their rows of one preallocated array.
+
+    Examples
+    --------
+    >>> shared, offset1, offset2 = [FT.Parameter(1) for i in range(3)]
+    >>> f1 = lambda T: shared() * T + offset1()
+    >>> f2 = lambda T: shared() * T + offset2()
+    >>> FT.fit_joint([(f1, [shared, offset1], y1, T1),
+    ...               (f2, [shared, offset2], y2, T2)])
+    """
+
+    # every Parameter once, in order
+    used = []
+    seen = set()
+    for data in datasets:
+        for p in data[1]:
+            if (id(p) not in seen):
+                seen.add(id(p))
+                used.append(p)
+
+    # fit the ParameterVector the Parameters belong to, if they all belong
+    # to one, so that a model reading it sees the trial values
+    vector = _owner(used[0])
+    if (vector is None or any(_owner(p) is not vector for p in used)):
+        if (any(isinstance(data[1], ParameterVector) for data in datasets)):
+            raise ValueError('fit_joint: the Parameters must either all ' +
+                             'belong to one ParameterVector, or be given ' +
+                             'as lists of Parameters')
+        vector = ParameterVector(used)
+    # the fit Parameters, by their index in `vector`, and their columns
+    # in the Jacobian
+    free = sorted(p._index for p in used)
+    column = dict((i, j) for j, i in enumerate(free))
+    params = [vector[i] for i in free]
+    k = len(free)
+    full = vector().copy()
+
+    def expand(values):
+        '''
+        the values of every Parameter of `vector`
+        '''
+        full[free] = values
+        return full
+
+    blocks = []
+    nRows = 0
+    nData = 0
+    indices = []
+    indptr = [np.zeros(1, dtype = int)]
+    for data in datasets:
+        function, dataParams, y, args = data[:4]
+        if (len(data) > 4 and data[4] is not None):
+            sigma = np.asarray(data[4], dtype = float)
+        else:
+            sigma = 1.
+        y = np.asarray(y, dtype = float)
+        m = len(y)
+
+        model = _model(function, args)
+
+        own = sorted(set(p._index for p in dataParams))
+        nCols = len(own)
+        blocks.append((model, _jacobian(model, vector, own), y, sigma,
+                       slice(nRows, nRows + m),
+                       slice(nData, nData + m * nCols), m, nCols))
+        # every row of this dataset has the same columns
+        indices.append(np.tile([column[i] for i in own], m))
+        indptr.append(nData + nCols * np.arange(1, m + 1))
+        nRows += m
+        nData += m * nCols
+    indices = np.concatenate(indices)
+    indptr = np.concatenate(indptr)
+    residuals = np.empty(nRows)
+    jacData = np.empty(nData)
+
+    def f(values):
+        vector.set(expand(values))
+        for model, dModel, y, sigma, rows, data, m, nCols in blocks:
+            out = residuals[rows]
+            np.subtract(y, model(), out = out)
+            out /= sigma
+        # least_squares keeps earlier residuals, so it needs a copy
+        return residuals.copy()
+
+    def jac(values):
+        values = expand(values)
+        for model, dModel, y, sigma, rows, data, m, nCols in blocks:
+            jacData[data].reshape(m, nCols)[:] = -(dModel(values) / sigma).T
+        return sparse.csr_matrix((jacData.copy(), indices, indptr),
+                                 shape = (nRows, k))
+
+    result = optimize.least_squares(f, full[free], jac = jac, **fitOpts)
+    if (rawOutput):
+        return result
+    # print warnings
+    if (result.status <= 0):
+        print 'fit_joint: Warning: ' + result.message
+
+    # leave the parameters at the best fit
+    p = result.x
+    fMin = np.sum(f(p) ** 2)
+    gofResiduals = [y - np.broadcast_to(model(), y.shape)
+                    for model, dModel, y, sigma, rows, data, m, nCols
+                    in blocks]
+    J = jac(p)
+    vector.set(expand(p))
+    try:
+        cov = np.linalg.inv(J.T.dot(J).toarray())
+    except np.linalg.LinAlgError:
+        cov = np.linalg.pinv(J.T.dot(J).toarray())
+
+    chi2Reduced = fMin / (nRows - k)
+    rmsErr = np.sqrt(sum(np.sum(r * r) for r in gofResiduals))
+    gof = {'residuals': gofResiduals, 'Reduced Chi2': chi2Reduced,
+           'RMS error': rmsErr, 'cov': cov}
+    for i, param in enumerate(params):
+        param.setVariance(abs(cov[i][i]))
+    return params, gof
+
+def _profileMinimize(problem, i, value, start):
+    '''
+    minimize chi2 with parameter `i` fixed at `value`, starting the other
+    parameters from `start`.  If `i` is None, every parameter is free.
+    Returns chi2 and the parameter values.
+    '''
+    vector, model, dModel, y, sigma, scale = problem
+    free = [j for j in range(len(start)) if j != i]
+    values = np.array(start, dtype = float)
+    if (i is not None):
+        values[i] = value
+
+    def f(q):
+        values[free] = q
+        vector.set(values)
+        return (y - model()) / sigma
+    def Dfun(q):
+        values[free] = q
+        return -dModel(values)[free] / sigma
+
+    if (free):
+        values[free] = optimize.leastsq(f, values[free], Dfun = Dfun,
+                                        col_deriv = True)[0]
+    r = f(values[free])
+    return np.sum(r * r) / scale, values.copy()
+
+def _profileScan(state, task):
+    '''
+    step parameter `i` away from the best fit in `direction` until chi2
+    rises by dChi2.  Each point starts from the optimum of the one before.
+    Returns the parameter index, the direction, the bound and the
+    (value, chi2 - best chi2) of each point.
+    '''
+    i, direction = task
+    problem, best, chi2Min, steps, dChi2, maxSteps = state
+    value, start, last = best[i], best, 0.
+    step = direction * steps[i]
+    points = []
+    for n in range(maxSteps):
+        chi2, optimum = _profileMinimize(problem, i, value + step, start)
+        delta = chi2 - chi2Min
+        points.append((value + step, delta))
+        if (delta >= dChi2):
+            g = lambda v: (_profileMinimize(problem, i, v, start)[0] -
+                           chi2Min - dChi2)
+            bound = optimize.brentq(g, value, value + step,
+                                    xtol = 1e-6 * abs(step))
+            return i, direction, bound, points
+        value, start = value + step, optimum
+        # take longer steps where the profile is flat
+        if (delta - last < dChi2 / 4.):
+            step *= 2
+        last = delta
+
+    print 'profile: Warning: Confidence interval did not converge'
+    return i, direction, direction * np.Inf, points
+
+def profile(function, params, y, args, errors = None, dChi2 = 1.,
+            maxSteps = 50, processes = None, jacobian = None):
+    """
+    Find confidence intervals from the profile likelihood
+
+    Each parameter is stepped away from the best fit in both directions.
+    At every step the other parameters are fit again, so correlations
+    between the parameters are accounted for.  The interval ends where
+    chi2 has risen by `dChi2`.
+
+    Parameters
+    ----------
+    function : callable
+              the fitted function, as for `fit`.
+    params : iterable
+            The Parameters, or a ParameterVector, at their best fit
+            values.  The best fit is found again from these values with
+            optimize.leastsq, weighted by `errors` only: the `weights`
+            and `algorithm` given to `fit` are not used.
+    y : array-like
+       the measured y-values
+    args : array-like
+       the values at which `y` was measured, as well as any other
+       inputs to `function`.
+    errors : array-like, optional
+            The standard deviation of each point.  If it is None, the
+            errors are taken to be equal, and are found from the scatter
+            of the best fit.  Defaults to None.
+    dChi2 : float, optional
+           The rise in chi2 that bounds the interval.  1 gives the 68%
+           interval of a single parameter.  Defaults to 1.
+    maxSteps : int, optional
+              The maximum number of steps in each direction.  If the
+              bound is not reached, it is set to +-inf.  Defaults to 50.
+    processes : int, optional
+               The number of worker processes.  The two directions of
+               every parameter are scanned concurrently.  Defaults to the
+               number of cpus.  If 1, the scans are done in this process.
+    jacobian : callable, optional
+              The derivatives of `function`, as for `fit`.
+
+    Returns
+    -------
+    intervals : array
+               The (lower, upper) interval of each parameter.  These are
+               also set on each Parameter with `setConfInt`.
+    profiles : list
+              For each parameter, an array of the parameter values and
+              an array of chi2 - best chi2, sorted by parameter value.
+
+    Notes
+    -----
+    The first step is half of the parameter's standard error, and the
+    step doubles wherever the profile is flat.  The bound is then found
+    with brentq.  The worker processes are forked, as for `fit_many`.
+
+    Examples
+    --------
+    >>> a, b = FT.Parameter(1), FT.Parameter(0)
+    >>> f = lambda x: a() * x + b()
+    >>> FT.fit(f, [a, b], y, x, errors = err)
+    >>> intervals, profiles = FT.profile(f, [a, b], y, x, errors = err)
+    >>> a.getConfInt()
+    """
+
+    if (isinstance(params, ParameterVector)):
+        vector = params
+    else:
+        vector = ParameterVector(params)
+    params = vector.params
+    k = len(params)
+    y = np.asarray(y, dtype = float)
+
+    model = _model(function, args)
+    if (jacobian is not None):
+        def dModel(values):
+            vector.set(values)
+            return np.asarray(model(jacobian))
+    else:
+        dModel = _jacobian(model, vector)
+    if errors is not None:
+        sigma = np.asarray(errors, dtype = float)
+    else:
+        sigma = 1.
+
+    # the best fit, and the standard error of each parameter
+    chi2Min, best = _profileMinimize((vector, model, dModel, y, sigma, 1.),
+                                     None, None, vector())
+    J = dModel(best) / sigma
+    try:
+        cov = np.linalg.inv(np.dot(J, J.T))
+    except np.linalg.LinAlgError:
+        cov = np.linalg.pinv(np.dot(J, J.T))
+    scale = 1.
+    if errors is None:
+        # scale chi2 so that the best fit has a reduced chi2 of 1
+        scale = chi2Min / (len(y) - k)
+        cov = cov * scale
+        chi2Min = chi2Min / scale
+    steps = 0.5 * np.sqrt(dChi2 * np.abs(np.diagonal(cov)))
+    bad = ~np.isfinite(steps) | (steps == 0)
+    steps[bad] = 0.1 * np.where(best[bad] != 0, np.abs(best[bad]), 1)
+
+    tasks = [(i, direction) for i in range(k) for direction in (-1, 1)]
+    problem = (vector, model, dModel, y, sigma, scale)
+    try:
+        results = _map(_profileScan, tasks, processes,
+                       (problem, best, chi2Min, steps, dChi2, maxSteps))
+    finally:
+        vector.set(best)
+
+    intervals = np.empty((k, 2))
+    points = [[(best[i], 0.)] for i in range(k)]
+    for i, direction, bound, scan in results:
+        intervals[i, (direction + 1) // 2] = bound
+        points[i].extend(scan)
+    profiles = []
+    for i, p in enumerate(params):
+        p.setConfInt(intervals[i])
+        values, delta = np.array(sorted(points[i])).T
+        profiles.append((values, delta))
+    return intervals, profiles
+
+def _take(a, index, n):
+    '''
+    return the points `index` of `a` if its last axis has one entry per
+    point, and `a` unchanged otherwise
+    '''
+    if (a is None or np.ndim(a) == 0 or np.shape(a)[-1] != n):
+        return a
+    return np.asarray(a)[..., index]
+
+def _resampleChunk(state, indices):
+    '''
+    fit the resamples in `indices` of a bootstrap or jackknife problem
+    '''
+    (function, vector, best, y, residuals, args, errors, nArgs, method,
+     seed, fitOpts) = state
+    n = len(y)
+    out = []
+    for i in indices:
+        if (method == 'jackknife'):
+            # i is a block of points to leave out
+            index = np.setdiff1d(np.arange(n), i)
+        else:
+            # a separate stream for each resample, so the results do not
+            # depend on how the resamples are shared between processes
+            rng = np.random.RandomState([seed, i])
+            index = rng.randint(0, n, n)
+
+        if (method == 'residual'):
+            # y is the best fit here
+            newY = residuals[index]
+            if errors is not None:
+                newY = newY * errors
+            newY = y + newY
+            newArgs, newErrors = args, errors
+        else:
+            newY = y[index]
+            if (nArgs > 1):
+                newArgs = [_take(a, index, n) for a in args]
+            else:
+                newArgs = _take(args, index, n)
+            newErrors = _take(errors, index, n)
+
+        vector.set(best)
+        fit(function, vector, newY, newArgs, errors = newErrors, **fitOpts)
+        out.append(vector().copy())
+    return out
+
+def _resample(function, params, y, args, errors, method, tasks, seed,
+              processes, chunksize, fitOpts):
+    '''
+    fit `y` once, then fit each resample in `tasks` from the best fit.
+    Returns the best fit values and an array of the resampled values.
+    '''
+    # fit into the caller's ParameterVector, as for fit_many
+    if (isinstance(params, ParameterVector)):
+        vector = params
+        bindings = [(vector.values, i) for i in range(len(vector))]
+    else:
+        params = list(params)
+        bindings = [(p._values, p._index) for p in params]
+        vector = ParameterVector(params)
+    params = vector.params
+    y = np.asarray(y, dtype = float)
+    if errors is not None:
+        errors = np.asarray(errors, dtype = float)
+
+    try:
+        gof = fit(function, vector, y, args, errors = errors, **fitOpts)[1]
+        best = vector().copy()
+        residuals = None
+        if (method == 'residual'):
+            # resample the residuals in units of the errors
+            residuals = gof['residuals']
+            y = y - residuals
+            if errors is not None:
+                residuals = residuals / errors
+
+        if (chunksize is None):
+            if (processes is None):
+                nChunks = 4 * multiprocessing.cpu_count()
+            else:
+                nChunks = 4 * processes
+            chunksize = max(1, int(np.ceil(len(tasks) / float(nChunks))))
+        chunks = [tasks[i:i + chunksize]
+                  for i in range(0, len(tasks), chunksize)]
+
+        results = _map(_resampleChunk, chunks, processes,
+                       (function, vector, best, y, residuals, args, errors,
+                        _nArgs(function), method, seed, fitOpts))
+    finally:
+        for p, (array, index) in zip(params, bindings):
+            p._bind(array, index)
+    for p, value in zip(params, best):
+        p.set(value)
+    return best, np.array([v for chunk in results for v in chunk])
+
+def bootstrap(function, params, y, args, errors = None, method = 'residual',
+              nSamples = 1000, level = 0.68, seed = None, processes = None,
+              chunksize = None, **fitOpts):
+    """
+    Estimate the parameter uncertainties by bootstrap resampling
+
+    Parameters
+    ----------
+    function : callable
+              the function to fit, as for `fit`.
+    params : iterable
+            A list of Parameters, or a ParameterVector, with their
+            starting values set.
+    y : array-like
+       the measured y-values
+    args : array-like
+       the values at which `y` was measured, as well as any other
+       inputs to `function`.
+    errors : array-like, optional
+            The standard deviation of each point.  Defaults to None.
+    method : string, optional
+            How the data are resampled.  Valid values are:
+            * 'residual': the best fit plus resampled residuals (default).
+              With `errors`, the residuals are resampled in units of the
+              errors.
+            * 'pairs': resampled points, with their `args` and `errors`
+    nSamples : int, optional
+              The number of resamples.  Defaults to 1000.
+    level : float, optional
+           The confidence level of the percentile intervals.  Defaults
+           to 0.68.
+    seed : int, optional
+          Seeds the random numbers, so the samples are reproducible for
+          any number of processes.  Defaults to None.
+    processes : int, optional
+               The number of worker processes.  Defaults to the number of
+               cpus.  If 1, the fits are done in this process.
+    chunksize : int, optional
+               The number of resamples sent to a worker at a time.
+               Defaults to about four chunks per worker.
+    **fitOpts : dict, optional
+               Passed to `fit`.
+
+    Returns
+    -------
+    samples : array
+             The fit values of each resample, with shape (nSamples,
+             n params)
+    intervals : array
+               The (lower, upper) percentile interval of each parameter
+
+    Notes
+    -----
+    `y` is fit first, and every resample is fit starting from the best
+    fit, where the Parameters are left.  An argument of `function` is
+    resampled by 'pairs' if its last axis has one entry per point.  The
+    worker processes are forked, as for `fit_many`.
+
+    Examples
+    --------
+    >>> a, b = FT.Parameter(1), FT.Parameter(0)
+    >>> f = lambda x: a() * x + b()
+    >>> samples, intervals = FT.bootstrap(f, [a, b], y, x, seed = 1)
+
+    A model may read a ParameterVector instead, which is fit in place:
+
+    >>> p = FT.ParameterVector([FT.Parameter(0.5), FT.Parameter(0)])
+    >>> g = lambda x: p()[0] * x + p()[1]
+    >>> x = np.linspace(0, 10, 50)
+    >>> y = 2 * x + 1 + 0.1 * np.sin(7 * x)
+    >>> samples, intervals = FT.bootstrap(g, p, y, x, nSamples = 20,
+    ...                                   seed = 1, processes = 1)
+    >>> np.allclose(samples.mean(axis = 0), [2, 1], atol = 0.05)
+    True
+    >>> np.allclose(p(), [2, 1], atol = 0.05)
+    True
+    """
+
+    if (method not in ('residual', 'pairs')):
+        raise ValueError("bootstrap: method must be 'residual' or 'pairs'")
+    if (seed is None):
+        seed = np.random.randint(2 ** 31)
+
+    best, samples = _resample(function, params, y, args, errors, method,
+                              range(nSamples), seed, processes, chunksize,
+                              fitOpts)
+    q = 50 * (1 - level)
+    intervals = np.percentile(samples, [q, 100 - q], axis = 0).T
+    return samples, intervals
+
+def jackknife(function, params, y, args, errors = None, nGroups = None,
+              level = 0.68, processes = None, chunksize = None, **fitOpts):
+    """
+    Estimate the parameter uncertainties by the delete-a-group jackknife
+
+    Parameters
+    ----------
+    function, params, y, args, errors :
+              As for `bootstrap`.
+    nGroups : int, optional
+             The points are split into `nGroups` contiguous groups, and
+             each is left out in turn.  Defaults to one group per point.
+    level : float, optional
+           The confidence level of the intervals.  Defaults to 0.68.
+    processes, chunksize, **fitOpts :
+              As for `bootstrap`.
+
+    Returns
+    -------
+    samples : array
+             The fit values with each group left out, with shape
+             (nGroups, n params)
+    intervals : array
+               The (lower, upper) interval of each parameter.  These are
+               the best fit +- the jackknife standard error, scaled to
+               `level` as for a normal distribution.
+    """
+
+    n = len(y)
+    if (nGroups is None):
+        nGroups = n
+    groups = np.array_split(np.arange(n), nGroups)
+
+    best, samples = _resample(function, params, y, args, errors,
+                              'jackknife', groups, None, processes,
+                              chunksize, fitOpts)
+    var = (nGroups - 1.) / nGroups * \
+          np.sum((samples - samples.mean(axis = 0)) ** 2, axis = 0)
+    width = stats.norm.ppf(0.5 + level / 2.) * np.sqrt(var)
+    intervals = np.array([best - width, best + width]).T
+    return samples, intervals
+
+class CancelledError(Exception):
+    '''
+    Raised by FitFuture.result if the fit was cancelled
+    '''
+    pass
+
+# serializes copying fit results back into Parameters
+_applyLock = threading.Lock()
+
+def _fitProcess(conn, function, params, start, y, args, interval, fitOpts):
+    '''
+    run one fit in a forked process, sending progress and the result
+    down `conn`
+    '''
+    last = [0.]
+    def progress(values, chi2):
+        now = timeit.default_timer()
+        if (now - last[0] >= interval):
+            last[0] = now
+            conn.send(('progress', np.array(values), chi2))
+    try:
+        for p, value in zip(params, start):
+            p.set(value)
+        params, gof = fit(function, params, y, args, callback = progress,
+                          **fitOpts)
+        conn.send(('done', np.array([p() for p in params]),
+                   [(p.var, p.interval) for p in params], gof))
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+    finally:
+        conn.close()
+
+class FitFuture(object):
+    """
+    A fit submitted to a FitPool.  It runs in its own forked process, so
+    fits of the same Parameters do not interfere, and the Parameters are
+    only changed when `result` copies the fit back into them.
+
+    Methods are safe to call from any thread.  Callbacks are called from
+    the pool's manager thread, so an event loop should pass them on with
+    its thread-safe scheduling call (e.g. call_soon_threadsafe).
+    """
+
+    def __init__(self, params, timeout = None, progress = None):
+        self.params = params
+        self.timeout = timeout
+        self.progress = progress
+        self._condition = threading.Condition()
+        self._state = 'pending'
+        self._result = None
+        self._error = None
+        self._callbacks = []
+        self._pool = None
+
+    def _finish(self, state, result = None, error = None):
+        '''
+        set the final state, and call the done callbacks
+        '''
+        with self._condition:
+            if (self._state in ('finished', 'cancelled')):
+                return
+            self._state = state
+            self._result = result
+            self._error = error
+            self._condition.notify_all()
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            callback(self)
+
+    def running(self):
+        return self._state == 'running'
+
+    def cancelled(self):
+        return self._state == 'cancelled'
+
+    def done(self):
+        return self._state in ('finished', 'cancelled')
+
+    def cancel(self):
+        '''
+        Cancel the fit, killing its process if it is running.  Returns
+        False if the fit had already finished.
+        '''
+        if (self.done()):
+            return False
+        self._pool._cancel(self)
+        self._finish('cancelled')
+        return self.cancelled()
+
+    def add_done_callback(self, callback):
+        '''
+        call `callback` with this future when the fit finishes or is
+        cancelled, or now if it already has
+        '''
+        with self._condition:
+            if (not self.done()):
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self, timeout = None, apply = True):
+        '''
+        Wait for the fit and return (params, gof), as `fit` does.
+
+        Parameters
+        ----------
+        timeout : float, optional
+                 The most seconds to wait.  multiprocessing.TimeoutError
+                 is raised if the fit has not finished by then.  Defaults
+                 to waiting for ever.
+        apply : bool, optional
+               If true, the best fit values, variances and confidence
+               intervals are copied into the Parameters.  Defaults to
+               True.
+        '''
+        deadline = None
+        if (timeout is not None):
+            deadline = timeit.default_timer() + timeout
+        with self._condition:
+            while (not self.done()):
+                if (deadline is None):
+                    # a timeout keeps the wait interruptible
+                    self._condition.wait(1.)
+                else:
+                    remaining = deadline - timeit.default_timer()
+                    if (remaining <= 0):
+                        raise multiprocessing.TimeoutError(
+                            'FitFuture: the fit did not finish in time')
+                    self._condition.wait(remaining)
+        if (self._state == 'cancelled'):
+            raise CancelledError('FitFuture: the fit was cancelled')
+        if (self._error is not None):
+            raise self._error
+
+        values, errors, gof = self._result
+        if (apply):
+            with _applyLock:
+                for p, value, (var, interval) in zip(self.params, values,
+                                                      errors):
+                    p.set(value)
+                    p.setVariance(var)
+                    p.setConfInt(interval)
+        return self.params, gof
+
+class FitPool(object):
+    """
+    Runs fits in the background, at most `processes` at a time.
+
+    Each fit is forked into its own process when it starts, so `function`
+    does not need to be picklable, and its Parameters are copied into the
+    process.  A manager thread starts the fits, passes on their progress,
+    and enforces timeouts.
+
+    Parameters
+    ----------
+    processes : int, optional
+               The most fits to run at once.  Defaults to the number of
+               cpus.
+    progressInterval : float, optional
+                      The least time between progress reports from one
+                      fit, in seconds.  Defaults to 0.5.
+
+    Examples
+    --------
+    >>> pool = FT.FitPool()
+    >>> future = pool.submit(f, [a, b], y, x, timeout = 10)
+    >>> future.add_done_callback(lambda future: ...)
+    >>> params, gof = future.result()
+    >>> pool.close()
+    """
+
+    def __init__(self, processes = None, progressInterval = 0.5):
+        if (processes is None):
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.progressInterval = progressInterval
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        # future -> [process, connection, deadline]
+        self._running = {}
+        self._closed = False
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target = self._manage)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, function, params, y, args, timeout = None,
+               progress = None, **fitOpts):
+        """
+        Start a fit in the background, and return its FitFuture
+
+        Parameters
+        ----------
+        function, params, y, args :
+                  As for `fit`.  The starting values of `params` and `y`
+                  are copied now, but `args` is used when the fit starts.
+        timeout : float, optional
+                 The most seconds the fit may run.  After that its process
+                 is killed, and `result` raises multiprocessing.
+                 TimeoutError.  Defaults to None.
+        progress : callable, optional
+                  Called with the parameter values and chi2 as the fit
+                  runs, at most once per `progressInterval`.
+        **fitOpts : dict, optional
+                   Passed to `fit`.
+        """
+        # a ParameterVector goes to the fit process as it is, so that a
+        # model reading it sees the trial values there
+        if (not isinstance(params, ParameterVector)):
+            params = list(params)
+        future = FitFuture(params, timeout, progress)
+        future._pool = self
+        job = (function, params, np.array([p() for p in params]),
+               np.array(y, dtype = float), args, fitOpts)
+        with self._lock:
+            if (self._closed):
+                raise RuntimeError('FitPool: the pool is closed')
+            self._pending.append((future, job))
+        self._wake.set()
+        return future
+
+    def _cancel(self, future):
+        '''
+        remove `future` from the queue, or kill its process
+        '''
+        with self._lock:
+            for item in self._pending:
+                if (item[0] is future):
+                    self._pending.remove(item)
+                    return
+            if (future in self._running):
+                process, conn, deadline = self._running.pop(future)
+                process.terminate()
+                process.join()
+                conn.close()
+
+    def _manage(self):
+        '''
+        the manager thread: start fits, read their messages and enforce
+        their timeouts
+        '''
+        while True:
+            with self._lock:
+                while (self._pending and
+                       len(self._running) < self.processes):
+                    future, job = self._pending.popleft()
+                    self._start(future, job)
+                if (self._closed and not self._pending and
+                    not self._running):
+                    return
+                conns = dict((item[1], future) for future, item
+                             in self._running.items())
+            if (not conns):
+                self._wake.wait(0.1)
+                self._wake.clear()
+                continue
+
+            try:
+                ready = select.select(list(conns), [], [], 0.05)[0]
+            except (ValueError, IOError, select.error):
+                # a connection was closed by a cancellation
+                continue
+            for conn in ready:
+                self._receive(conns[conn], conn)
+
+            now = timeit.default_timer()
+            for future, (process, conn, deadline) in list(
+                self._running.items()):
+                if (deadline is not None and now > deadline):
+                    self._cancel(future)
+                    future._finish('finished', error =
+                                   multiprocessing.TimeoutError(
+                                       'FitPool: the fit timed out'))
+
+    def _start(self, future, job):
+        '''
+        fork a process for `future`.  Called with the lock held.
+        '''
+        function, params, start, y, args, fitOpts = job
+        parent, child = multiprocessing.Pipe(duplex = False)
+        process = multiprocessing.Process(
+            target = _fitProcess,
+            args = (child, function, params, start, y, args,
+                    self.progressInterval, fitOpts))
+        process.start()
+        child.close()
+        deadline = None
+        if (future.timeout is not None):
+            deadline = timeit.default_timer() + future.timeout
+        self._running[future] = [process, parent, deadline]
+        future._state = 'running'
+
+    def _receive(self, future, conn):
+        '''
+        handle a message from the process of `future`
+        '''
+        try:
+            message = conn.recv()
+        except (EOFError, IOError):
+            message = ('error', 'the fit process exited unexpectedly')
+        if (message[0] == 'progress'):
+            if (future.progress is not None):
+                future.progress(message[1], message[2])
+            return
+        with self._lock:
+            item = self._running.pop(future, None)
+        if (item is None):
+            # cancelled meanwhile
+            return
+        item[0].join()
+        conn.close()
+        if (message[0] == 'done'):
+            future._finish('finished', result = message[1:])
+        else:
+            future._finish('finished', error = RuntimeError(
+                'FitPool: the fit failed:\n' + message[1]))
+
+    def close(self):
+        '''
+        stop taking fits.  Those already submitted still run.
+        '''
+        with self._lock:
+            self._closed = True
+        self._wake.set()
+
+    def join(self):
+        '''
+        wait for the fits to finish.  Call `close` first.
+        '''
+        self._thread.join()
+
+    def terminate(self):
+        '''
+        cancel every fit and stop the pool
+        '''
+        with self._lock:
+            futures = [item[0] for item in self._pending]
+            futures.extend(self._running)
+        for future in futures:
+            future.cancel()
+        self.close()
+        self.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        self.join()
+
+# the pool used by fit_async
+_defaultPool = None
+_defaultPoolLock = threading.Lock()
+
+def fit_async(function, params, y, args, timeout = None, progress = None,
+              **fitOpts):
+    """
+    Start a fit without blocking, and return its FitFuture
+
+    The fit runs in a shared FitPool, with one process per cpu.  The
+    arguments are as for FitPool.submit.  An event loop can wait for the
+    result by adding a done callback that hands it back to the loop.
+
+    Examples
+    --------
+    >>> future = FT.fit_async(f, [a, b], y, x, timeout = 10)
+    >>> ...
+    >>> if future.done():
+    ...     params, gof = future.result()
+    """
+
+    global _defaultPool
+    with _defaultPoolLock:
+        if (_defaultPool is None):
+            _defaultPool = FitPool()
+    return _defaultPool.submit(function, params, y, args, timeout = timeout,
+                               progress = progress, **fitOpts)
+
 def ConfInt(function, y, args, param, fMin = None, weights = None, dChi2 = 4):
+    # Superseded by profile, which re-fits the other parameters
     # Does this work?
     np.seterr(invalid = 'ignore', divide = 'ignore')
     if (weights == None):
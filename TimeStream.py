@@ -1,111 +1,1291 @@
-import datetime as dt
+import json
+import warnings
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
+from numpy.lib import stride_tricks
+from scipy import ndimage, signal
 
-class TimeStream:
+NS_PER_SECOND = 1000000000
+
+# on-disk format: the magic string and the length of the json header,
+# followed by the header and then the data sections, each aligned to
+# FILE_ALIGN bytes
+FILE_MAGIC = b'TSTREAM1'
+FILE_ALIGN = 64
+
+def _aligned(offset):
+    return -(-offset // FILE_ALIGN) * FILE_ALIGN
+
+def _read_header(path):
+    '''
+    read the header of a TimeStream file.  Returns the header dictionary and
+    the offset of the first data section.
+    '''
+
+    with open(path, 'rb') as f:
+        if (f.read(len(FILE_MAGIC)) != FILE_MAGIC):
+            raise ValueError('%s is not a TimeStream file' %path)
+        length = int(np.frombuffer(f.read(8), dtype = '<u8')[0])
+        header = json.loads(f.read(length).decode('ascii'))
+    return header, _aligned(len(FILE_MAGIC) + 8 + length)
+
+# spectral windows, cached by (name, length)
+_WINDOWS = {}
+
+def _window(name, n):
+    '''
+    return the periodic spectral window `name` ('hann', 'hamming' or
+    'boxcar') of length `n`
+    '''
+
+    if ((name, n) not in _WINDOWS):
+        if (name == 'hann'):
+            w = np.hanning(n + 1)[:-1]
+        elif (name == 'hamming'):
+            w = np.hamming(n + 1)[:-1]
+        elif (name == 'boxcar'):
+            w = np.ones(n)
+        else:
+            raise ValueError('Unknown window %s' %name)
+        w.flags.writeable = False
+        _WINDOWS[(name, n)] = w
+    return _WINDOWS[(name, n)]
+
+def _sample_mask(values):
+    '''
+    return the mask of the samples for which every channel of `values` is
+    masked
+    '''
+
+    mask = np.ma.getmask(values)
+    if (mask is np.ma.nomask or mask.ndim <= 1):
+        return mask
+    return mask.reshape((-1, mask.shape[-1])).all(axis = 0)
+
+def _map(path, dtype, offset, shape):
+    '''
+    memory map one section of a TimeStream file
+    '''
+
+    if (np.prod(shape) == 0):
+        return np.zeros(shape, dtype = dtype)
+    return np.memmap(path, dtype = dtype, mode = 'r', offset = offset,
+                     shape = shape)
+
+class TimeStream(object):
     """
     Contains a pair of vectors: data points and the times they were collected
 
-    This class provides convenient access to a data time stream.  It will
-    eventually provide support for various time standards (labview, matlab,
-    linux, windows?).  Calling the object will return the vector of data
-    points.
+    This class provides convenient access to a data time stream.  Times are
+    stored internally as numpy.datetime64[ns] (UTC), and can be read or
+    written in any of the formats in `TIME_TYPES` (matlab, labview, unix,
+    mjd), or as datetime objects ('datetime').  Further formats can be added
+    with `register_time_type`.  Calling the object will return the vector
+    of data points.
     """
     
-    TIME_TYPES = ['matlab', 'labview', 'unix']
+    TIME_TYPES = {}
+    # attributes, besides the data, that are stored in saved files
+    _HEADER_KEYS = ()
+    # growable storage used by append: the time stream is a view of
+    # [_start, _stop) of these buffers
+    _tBuf = None
+    _span = None
+    _maxlen = None
+
     def __init__(self, values, t, timeType, mask = np.ma.nomask):
         if (not isinstance(values, np.ma.MaskedArray)):
             self.values = np.ma.array(values, mask = mask)
         else:
             self.values = values
-        
+
         timeType = timeType.lower()
-        self._CheckTimeType(timeType)
-        if (timeType == 'matlab'):
-            # significant hackery here: matlab defines
-            # datenum('Jan-1-0000 00:00:00') = 1, whereas fromordinal
-            # considers 1/1/0001 to be 1.
-            t = [dt.datetime.fromordinal(np.floor(t[i])) - \
-                     dt.timedelta(days = 366) + \
-                     dt.timedelta(t[i] % 1) for i in range(len(t))]
-        elif (timeType == 'unix'):
-            t = [dt.datetime.fromtimestamp(t[i]) \
-                      for i in range(len(t))]
-        elif (timeType == 'labview'):
-            delta = dt.datetime(1904, 1, 1, 0, 0, 0) - \
-                    dt.datetime(1970, 1, 1, 0, 0, 0)
-            t += delta.total_seconds()
-            t = [dt.datetime.fromtimestamp(t[i]) \
-                      for i in range(len(t))]
-
-        self.t = np.ma.array(t, mask = self.values.mask)
-
-    def derivative(self, gaps = True):
+        self._check_time_type(timeType)
+        t = self._to_ns(np.ma.getdata(t), timeType)
+        self.t = np.ma.array(t.view('datetime64[ns]'),
+                             mask = _sample_mask(self.values))
+
+    @classmethod
+    def register_time_type(cls, timeType, epoch, unit):
+        '''
+        Add a numeric time standard
+
+        Parameters
+        ----------
+        timeType : string
+            the name of the time standard, as passed to `__init__` and
+            `get_time`
+        epoch : datetime.datetime, numpy.datetime64 or string
+            the (UTC) time at which the standard reads zero
+        unit : float
+            the length of one unit of the standard, in seconds
+        '''
+
+        # the epoch is kept as a whole number of units plus a remainder in
+        # nanoseconds, so that far-off epochs (matlab) do not overflow int64
+        epoch = int(np.datetime64(epoch, 'us').astype(np.int64)) * 1000
+        unit = int(round(unit * NS_PER_SECOND))
+        cls.TIME_TYPES[timeType.lower()] = divmod(epoch, unit) + (unit,)
+
+    @classmethod
+    def _to_ns(cls, t, timeType):
+        '''
+        convert times in the format `timeType` to nanoseconds since the
+        unix epoch
+        '''
+
+        if (timeType == 'datetime'):
+            return np.asarray(t, dtype = 'datetime64[ns]').view(np.int64)
+        epochUnits, epochNs, unit = cls.TIME_TYPES[timeType]
+        t = np.asarray(t, dtype = np.float64)
+        # split off the whole units so that the fractional part keeps its
+        # precision when scaled to nanoseconds
+        whole = np.floor(t)
+        ns = (whole.astype(np.int64) + epochUnits) * unit
+        ns += np.round((t - whole) * unit).astype(np.int64)
+        ns += epochNs
+        return ns
+
+    def _from_ns(self, timeType):
+        '''
+        convert the time vector to the format `timeType`
+        '''
+
+        epochUnits, epochNs, unit = self.TIME_TYPES[timeType]
+        whole, frac = np.divmod(self._ns() - epochNs, unit)
+        return (whole - epochUnits) + frac / float(unit)
+
+    def _ns(self):
+        '''
+        return the time vector as integer nanoseconds since the unix epoch
+        '''
+
+        return np.ma.getdata(self.t).view(np.int64)
+
+    @classmethod
+    def _wrap(cls, values, t):
+        '''
+        build a TimeStream around an existing masked array of values and an
+        unmasked datetime64[ns] array of times without copying them
+        '''
+
+        obj = cls.__new__(cls)
+        obj.values = values
+        obj.t = np.ma.array(t, mask = _sample_mask(values), copy = False)
+        return obj
+
+    def _like(self, values, t):
+        '''
+        build a TimeStream of the same kind as this one around new arrays
+        '''
+
+        return self._wrap(values, t)
+
+    @classmethod
+    def _time_arg(cls, t, timeType = None):
+        '''
+        convert a time or an array of times to nanoseconds since the unix
+        epoch.  If `timeType` is None, `t` can be anything
+        numpy.datetime64 accepts.
+        '''
+
+        if (timeType is None):
+            return np.asarray(t, dtype = 'datetime64[ns]').view(np.int64)
+        timeType = timeType.lower()
+        cls._check_time_type(timeType)
+        return cls._to_ns(t, timeType)
+
+    def save(self, path, chunksize = 65536):
+        '''
+        Write the time stream to disk in a format that `open` can memory map
+
+        The file holds the time column, one column per channel of values
+        and the mask as a packed bitmask.  The samples are grouped into
+        chunks of `chunksize`, with an index of the first time in each
+        chunk, so that `open` only has to touch the chunks that a time
+        window covers.
+
+        Parameters
+        ----------
+        path : string
+            the file to write
+        chunksize : int, optional
+            the number of samples in a chunk.  Must be a multiple of 8.
+            Defaults to 65536.
+        '''
+
+        if (chunksize <= 0 or chunksize % 8 != 0):
+            raise ValueError('chunksize must be a positive multiple of 8')
+        ns = self._ns()
+        if (np.any(ns[1:] < ns[:-1])):
+            raise ValueError('Times must be sorted to save a TimeStream')
+        values = np.ma.getdata(self.values)
+        shape = values.shape[:-1]
+        n = len(ns)
+        nChunks = -(-n // chunksize)
+
+        # the mask, padded out to whole chunks, with one row per channel
+        mask = np.zeros(shape + (nChunks * chunksize,), dtype = bool)
+        mask[..., :n] = np.ma.getmaskarray(self.values)
+        masked = mask.reshape((int(np.prod(shape)), nChunks, chunksize))
+        masked = masked.any(axis = 2).any(axis = 0).astype(np.uint8)
+
+        sections = [('index', np.ascontiguousarray(ns[::chunksize])),
+                    ('masked', masked),
+                    ('t', np.ascontiguousarray(ns)),
+                    ('values', np.ascontiguousarray(values)),
+                    ('mask', np.packbits(mask, axis = -1))]
+        offsets = {}
+        offset = 0
+        for name, arr in sections:
+            offsets[name] = offset
+            offset = _aligned(offset + arr.nbytes)
+        header = {'n': n, 'shape': list(shape), 'dtype': values.dtype.str,
+                  'chunksize': chunksize, 'offsets': offsets}
+        for key in self._HEADER_KEYS:
+            header[key] = getattr(self, key)
+        header = json.dumps(header).encode('ascii')
+
+        with open(path, 'wb') as f:
+            f.write(FILE_MAGIC)
+            f.write(np.array([len(header)], dtype = '<u8').tobytes())
+            f.write(header)
+            start = _aligned(f.tell())
+            for name, arr in sections:
+                f.write(b'\0' * (start + offsets[name] - f.tell()))
+                arr.tofile(f)
+
+    @classmethod
+    def open(cls, path, start = None, stop = None, timeType = None):
+        '''
+        Open a time stream written by `save`
+
+        The time and value columns are memory mapped, so nothing is read
+        from disk until it is used.  Only the part of the bitmask covering
+        chunks that contain masked samples within [`start`, `stop`) is
+        unpacked.
+
+        Parameters
+        ----------
+        path : string
+            the file to open
+        start, stop : optional
+            Only load samples with `start` <= t < `stop`.  These are
+            interpreted as in `window`.  Defaults to the whole file.
+        timeType : string, optional
+            the time standard of `start` and `stop`.  If None, they are
+            interpreted by numpy.datetime64.
+
+        Returns
+        -------
+        A TimeStream backed by read-only memory maps of `path`
+        '''
+
+        header, base = _read_header(path)
+        offsets = header['offsets']
+        n = header['n']
+        shape = tuple(header['shape'])
+        chunksize = header['chunksize']
+        nChunks = -(-n // chunksize)
+
+        index = _map(path, np.int64, base + offsets['index'], (nChunks,))
+        masked = _map(path, np.uint8, base + offsets['masked'], (nChunks,))
+        t = _map(path, np.int64, base + offsets['t'], (n,))
+        values = _map(path, np.dtype(header['dtype']),
+                      base + offsets['values'], shape + (n,))
+
+        # find the chunks, then the samples, inside the window
+        c0, c1 = 0, nChunks
+        if (start is not None):
+            start = cls._time_arg(start, timeType)
+            # the chunk before the first one starting at or after `start`,
+            # which may end with samples at `start` itself
+            c0 = max(np.searchsorted(index, start, 'left') - 1, 0)
+        if (stop is not None):
+            stop = cls._time_arg(stop, timeType)
+            c1 = np.searchsorted(index, stop, 'left')
+        i0 = c0 * chunksize
+        i1 = max(min(c1 * chunksize, n), i0)
+        if (start is not None):
+            i0 += np.searchsorted(t[i0:i1], start, 'left')
+        if (stop is not None):
+            i1 = i0 + np.searchsorted(t[i0:i1], stop, 'left')
+
+        # unpack the mask only for chunks that have masked samples
+        mask = np.ma.nomask
+        flagged = c0 + np.flatnonzero(masked[c0:c1])
+        if (len(flagged) > 0):
+            packed = _map(path, np.uint8, base + offsets['mask'],
+                          shape + (nChunks * chunksize // 8,))
+            mask = np.zeros(shape + (i1 - i0,), dtype = bool)
+            for c in flagged:
+                lo = max(c * chunksize, i0)
+                hi = min((c + 1) * chunksize, i1)
+                bits = packed[..., c * chunksize // 8:
+                              (c + 1) * chunksize // 8]
+                bits = np.unpackbits(bits, axis = -1)
+                mask[..., lo - i0:hi - i0] = \
+                    bits[..., lo - c * chunksize:hi - c * chunksize]
+
+        values = np.ma.array(values[..., i0:i1], mask = mask, copy = False)
+        obj = cls._wrap(values, t[i0:i1].view('datetime64[ns]'))
+        for key in cls._HEADER_KEYS:
+            setattr(obj, key, header[key])
+        return obj
+
+    def window(self, start = None, stop = None, timeType = None):
+        '''
+        Return the samples with `start` <= t < `stop` as a new TimeStream
+
+        The result shares memory with this time stream.  The times must be
+        sorted.
+
+        Parameters
+        ----------
+        start, stop : optional
+            The ends of the window.  If `timeType` is None, these can be
+            anything numpy.datetime64 accepts (datetime objects, ISO 8601
+            strings, ...).  A value of None leaves that end open.
+        timeType : string, optional
+            the time standard of `start` and `stop`
+        '''
+
+        ns = self._ns()
+        i0, i1 = 0, len(ns)
+        if (start is not None):
+            i0 = np.searchsorted(ns, self._time_arg(start, timeType), 'left')
+        if (stop is not None):
+            i1 = np.searchsorted(ns, self._time_arg(stop, timeType), 'left')
+        i1 = max(i0, i1)
+        return self._like(self.values[..., i0:i1],
+                          np.ma.getdata(self.t)[i0:i1])
+
+    def derivative(self, gaps = True, out = None):
         """
         Return the time derivative of the time stream.
         In units of [value units]/second
+
+        Parameters
+        ----------
+        gaps : bool, optional
+            If True (default), masked samples are skipped and the derivative
+            is taken across them.  If False, the intervals next to masked
+            samples are dropped.
+        out : array, optional
+            A float array to hold the result.  It must have at least as many
+            elements as the result, and the result is a view of its start.
+
+        Returns
+        -------
+        For a single channel, an array of the derivative between each pair
+        of samples used.  For several channels, a masked array with one
+        entry per channel for each interval between consecutive samples,
+        masked where that channel has no derivative.  Compressing a row
+        gives the single channel result.
         """
-        self._check_masks()
-        if (gaps):
-            delta_val = diff(self.values.compressed())
-            delta_t = diff(self.t.compressed())
-        else:
-            delta_val = diff(self.values).compressed()
-            delta_t = diff(self.t).compressed()
-        for i in range(len(delta_t)):
-            delta_t[i] = delta_t[i].total_seconds()
-        return (delta_val / delta_t)
-    
-    def integral(self, gaps = True):
+
+        if (self.values.ndim > 1):
+            values, start, dt, used = self._intervals(gaps)
+            res = self._buffer(out, start.shape)
+            np.subtract(values[..., 1:], start, out = res)
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                res /= dt
+            res *= NS_PER_SECOND
+            return np.ma.array(res, mask = ~used, copy = False)
+
+        values, ns, adjacent = self._compressed()
+        res = self._buffer(out, (max(len(values) - 1, 0),))
+        np.subtract(values[1:], values[:-1], out = res)
+        res /= np.diff(ns)
+        res *= NS_PER_SECOND
+        if (not gaps and adjacent is not None):
+            keep = res[adjacent]
+            res = res[:len(keep)]
+            res[:] = keep
+        return res
+
+    def integral(self, gaps = True, cumulative = False, out = None):
         """
-        Return the time integral of the time stream.
+        Return the time integral of the time stream, using the trapezoid
+        rule.
         In units of [value units] * second
+
+        Parameters
+        ----------
+        gaps : bool, optional
+            If True (default), masked samples are skipped and the integral
+            is taken across them.  If False, the intervals next to masked
+            samples do not contribute.
+        cumulative : bool, optional
+            If True, return the running integral at each unmasked sample,
+            starting from 0.  Otherwise (default) return the total.
+        out : array, optional
+            A float array to hold the running integral.  It must have at
+            least as many elements as there are unmasked samples, and the
+            result is a view of its start.
+
+        Returns
+        -------
+        For a single channel, the total or an array of the running integral
+        at each unmasked sample.  For several channels, an array of totals
+        or a masked array of running integrals with the same shape as the
+        values.
         """
-        self._check_masks()
-        if (gaps):
 
+        if (self.values.ndim > 1):
+            values, start, dt, used = self._intervals(gaps)
+            res = self._buffer(out, values.shape)
+            res[..., :1] = 0
+            area = res[..., 1:]
+            np.add(values[..., 1:], start, out = area)
+            area *= dt
+            area *= 0.5 / NS_PER_SECOND
+            area[~used] = 0
+            if (cumulative):
+                np.cumsum(area, axis = -1, out = area)
+                return np.ma.array(res, mask = np.ma.getmaskarray(self.values),
+                                   copy = False)
+            return area.sum(axis = -1)
+
+        values, ns, adjacent = self._compressed()
+        res = self._buffer(out, (len(values),))
+        if (len(values) == 0):
+            return res if cumulative else 0.
+        res[0] = 0
+        area = res[1:]
+        np.add(values[1:], values[:-1], out = area)
+        area *= np.diff(ns)
+        area *= 0.5 / NS_PER_SECOND
+        if (not gaps and adjacent is not None):
+            area[~adjacent] = 0
+        if (cumulative):
+            np.cumsum(area, out = area)
+            return res
+        return area.sum()
+
+    def _compressed(self):
+        '''
+        return the unmasked values, their times in nanoseconds and a
+        boolean array marking which consecutive pairs of them are also
+        consecutive in the full time stream (None if nothing is masked)
+        '''
+
+        values = np.ma.getdata(self.values)
+        ns = self._ns()
+        mask = np.ma.getmask(self.values)
+        if (mask is np.ma.nomask or not mask.any()):
+            return values, ns, None
+        valid = ~mask
+        adjacent = np.diff(np.flatnonzero(valid)) == 1
+        return values[valid], ns[valid], adjacent
+
+    def _intervals(self, gaps):
+        '''
+        pair each sample after the first with the sample each channel
+        integrates or differentiates from: the previous unmasked sample if
+        `gaps` is set, otherwise the previous sample.  Returns the values,
+        the values at the start of each interval, the lengths of the
+        intervals in nanoseconds and a boolean array that is True where
+        both ends of an interval are unmasked.
+        '''
+
+        values = np.ma.getdata(self.values)
+        ns = self._ns()
+        valid = ~np.ma.getmaskarray(self.values)
+        if (not gaps):
+            return (values, values[..., :-1], np.diff(ns),
+                    valid[..., 1:] & valid[..., :-1])
+        # the index of the last unmasked sample at or before each sample
+        last = np.where(valid, np.arange(len(ns)), -1)
+        np.maximum.accumulate(last, axis = -1, out = last)
+        prev = last[..., :-1]
+        used = valid[..., 1:] & (prev >= 0)
+        prev = np.maximum(prev, 0)
+        start = np.take_along_axis(values, prev, axis = -1)
+        return values, start, ns[1:] - ns[prev], used
+
+    def _buffer(self, out, shape):
+        '''
+        return a float array of shape `shape`, using the start of the last
+        axis of `out` if it is given
+        '''
+
+        if (out is None):
+            return np.empty(shape)
+        if (out.shape[:-1] != shape[:-1] or out.shape[-1] < shape[-1]):
+            raise ValueError('out must have shape %s or longer' %(shape,))
+        return out[..., :shape[-1]]
+
+    def resample(self, period, how = 'mean', origin = None,
+                 timeType = None):
+        '''
+        Reduce the time stream to fixed-width time bins
+
+        Masked samples are ignored, and bins with no unmasked samples are
+        masked in the result.  The times must be sorted.
+
+        Parameters
+        ----------
+        period : float
+            the bin width, in seconds
+        how : string, optional
+            The reduction to apply to each bin: 'mean' (default), 'median',
+            'min', 'max', 'std' or 'count'.
+        origin : optional
+            The start of a bin.  Defaults to the last multiple of `period`
+            (counting from the unix epoch) before the first sample.
+        timeType : string, optional
+            the time standard of `origin`.  If None, it is interpreted by
+            numpy.datetime64.
+
+        Returns
+        -------
+        A new TimeStream with one sample per bin, timestamped at the center
+        of the bin.
+        '''
+
+        if (how not in ('mean', 'median', 'min', 'max', 'std', 'count')):
+            raise ValueError('Unknown reduction %s' %how)
+        period = int(round(period * NS_PER_SECOND))
+        ns = self._ns()
+        data = np.ma.getdata(self.values)
+        shape = data.shape[:-1]
+        nChannels = int(np.prod(shape))
+        valid = ~np.ma.getmaskarray(self.values).reshape((nChannels, -1))
+        used = ns[valid.any(axis = 0)]
+        if (origin is None):
+            origin = used[0] // period * period if len(used) > 0 else 0
+        else:
+            origin = self._time_arg(origin, timeType)
+        bins = (ns - origin) // period
+        first = (used[0] - origin) // period if len(used) > 0 else 0
+        nBins = (used[-1] - origin) // period - first + 1 if len(used) > 0 \
+                else 0
+
+        # number the bins of all channels together, so that one grouped
+        # reduction covers every channel
+        offset = np.arange(nChannels) * nBins - first
+        if (valid.all()):
+            bins = (bins + offset[:, None]).ravel()
+            values = data.reshape(-1)
+        else:
+            channel, sample = np.nonzero(valid)
+            bins = bins[sample] + offset[channel]
+            values = data.reshape((nChannels, -1))[channel, sample]
+        count = np.bincount(bins, minlength = nChannels * nBins)
+        empty = count == 0
+
+        if (how == 'count'):
+            res = np.ma.array(count)
+        elif (how == 'mean' or how == 'std'):
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                res = np.bincount(bins, values, len(count)) / count
+                if (how == 'std'):
+                    res = np.sqrt(np.bincount(bins, (values - res[bins]) ** 2,
+                                              len(count)) / count)
+            res = np.ma.array(res, mask = empty)
+        else:
+            # the samples of each bin are consecutive, since the times are
+            # sorted
+            starts = np.flatnonzero(np.diff(bins)) + 1
+            starts = np.concatenate(([0], starts)).astype(np.intp)
+            full = bins[starts]
+            res = np.ma.masked_all(len(count),
+                                   dtype = np.result_type(values, 0.))
+            if (len(values) == 0):
+                pass
+            elif (how == 'min'):
+                res[full] = np.minimum.reduceat(values, starts)
+            elif (how == 'max'):
+                res[full] = np.maximum.reduceat(values, starts)
+            else:
+                res[full] = self._median(values, starts, count[full])
+
+        res = res.reshape(shape + (nBins,))
+        t = origin + (first + np.arange(nBins)) * period + period // 2
+        return self._like(res, t.view('datetime64[ns]'))
+
+    def _median(self, values, starts, n):
+        '''
+        return the median of each group of consecutive values, where the
+        groups start at `starts` and have lengths `n`
+        '''
+
+        group = np.repeat(np.arange(len(n)), n)
+        if (len(n) * n.max() <= 2 * len(values)):
+            # pad the groups out to rows of equal length and sort the rows,
+            # which is much faster than a global sort when bins are similar
+            # in size
+            rows = np.full((len(n), n.max()), np.inf)
+            rows[group, np.arange(len(values)) - starts[group]] = values
+            rows.sort(axis = 1)
+            row = np.arange(len(n))
+            return 0.5 * (rows[row, (n - 1) // 2] + rows[row, n // 2])
+        values = values[np.lexsort((values, group))]
+        return 0.5 * (values[starts + (n - 1) // 2] + values[starts + n // 2])
+
+    def interpolate(self, t, timeType = None, maxgap = None):
+        '''
+        Linearly interpolate the time stream onto new times
+
+        Masked samples are ignored.  Points outside the span of the
+        unmasked samples are masked.  The times must be sorted.
+
+        Parameters
+        ----------
+        t : array-like
+            the times to interpolate to
+        timeType : string, optional
+            the time standard of `t`.  If None, it is interpreted by
+            numpy.datetime64.
+        maxgap : float, optional
+            If given, points that fall between two samples more than
+            `maxgap` seconds apart are masked.
+
+        Returns
+        -------
+        A new TimeStream at times `t`
+        '''
+
+        target = np.atleast_1d(self._time_arg(t, timeType))
+        res = self._lookup(target, 'linear', maxgap = maxgap)
+        return self._like(res, target.view('datetime64[ns]'))
+
+    def rolling(self, how = 'mean', size = None, span = None):
+        '''
+        Compute a statistic over a window centered on each sample
+
+        Masked samples are ignored.  Windows are cut short at the ends of
+        the time stream.  Exactly one of `size` and `span` must be given.
+
+        Parameters
+        ----------
+        how : string, optional
+            The statistic: 'mean' (default), 'std', 'count', 'median' or
+            'mad' (the median absolute deviation from the window median).
+            'mean', 'std' and 'count' use running sums, so they cost O(n)
+            whatever the window.  The median of odd `size` windows uses
+            scipy.ndimage.median_filter.
+        size : int, optional
+            the window length in samples
+        span : float, optional
+            the window length in seconds.  The times must be sorted.
+
+        Returns
+        -------
+        A new time stream of the same kind, with the statistic at each
+        sample.  Samples with no unmasked samples in their window are
+        masked.
+
+        The standard deviation stays accurate after a large step:
+
+        >>> level = np.where(np.arange(100) < 50, 0., 1000.)
+        >>> ts = TimeStream(level + 1e-3 * (np.arange(100) % 2),
+        ...                 np.arange(100.), 'unix')
+        >>> std = ts.rolling('std', size = 10).values
+        >>> np.allclose(std[60:95], 5e-4, rtol = 1e-9, atol = 0)
+        True
+        >>> np.all(ts.rolling('std', size = 1).values == 0)
+        True
+        '''
+
+        if (how not in ('mean', 'std', 'count', 'median', 'mad')):
+            raise ValueError('Unknown statistic %s' %how)
+        data, valid, lo, hi, count = self._rolling_setup(size, span)
+        if (how in ('mean', 'std', 'count')):
+            res = self._rolling_moments(data, valid, lo, hi, count, how)
+        else:
+            median, mad = self._rolling_median(data, valid, lo, hi, count,
+                                               size, how == 'mad')
+            res = median if how == 'median' else mad
+        shape = self.values.shape
+        res = np.ma.array(res.reshape(shape), mask = (count == 0).reshape(shape))
+        return self._like(res, np.ma.getdata(self.t))
+
+    def despike(self, threshold = 5., size = None, span = None,
+                compact = False):
+        '''
+        Mask samples that stand out from a rolling median
+
+        A sample is a spike if it is more than `threshold` robust standard
+        deviations (1.4826 times the rolling MAD) from the rolling median
+        of its channel.  The spikes are passed to `remove`.
+
+        Parameters
+        ----------
+        threshold : float, optional
+            the cut, in robust standard deviations.  Defaults to 5.
+        size, span : optional
+            the window, in samples or seconds; see `rolling`
+        compact : bool, optional
+            passed to `remove`.  Defaults to False, so that the spikes are
+            only masked.
+
+        Returns
+        -------
+        spikes : array
+            a boolean array, with the shape of the values, that is True for
+            the samples found to be spikes
+        '''
+
+        data, valid, lo, hi, count = self._rolling_setup(size, span)
+        median, mad = self._rolling_median(data, valid, lo, hi, count, size)
+        with np.errstate(invalid = 'ignore'):
+            # empty windows give NaN, which is never a spike
+            spikes = (np.abs(data - median) > threshold * 1.4826 * mad) & valid
+        spikes = spikes.reshape(self.values.shape)
+        self.remove(spikes, compact = compact)
+        return spikes
+
+    def _rolling_setup(self, size, span):
+        '''
+        return the data of each channel as the rows of a float array, which
+        of them are unmasked, the window bounds and the number of unmasked
+        samples in each window
+        '''
+
+        lo, hi = self._window_bounds(size, span)
+        data = np.ma.getdata(self.values).astype(np.float64)
+        data = data.reshape((-1, self.values.shape[-1]))
+        valid = ~np.ma.getmaskarray(self.values).reshape(data.shape)
+        return data, valid, lo, hi, self._running_sum(valid, lo, hi)
+
+    def _window_bounds(self, size, span):
+        '''
+        return the [start, stop) sample indices of the window centered on
+        each sample
+        '''
+
+        if ((size is None) == (span is None)):
+            raise ValueError('Give exactly one of size and span')
+        n = len(self.t)
+        if (size is not None):
+            lo = np.arange(n) - size // 2
+            hi = lo + size
+            return np.clip(lo, 0, n), np.clip(hi, 0, n)
+        ns = self._ns()
+        half = int(round(span * NS_PER_SECOND / 2.))
+        return (np.searchsorted(ns, ns - half, 'left'),
+                np.searchsorted(ns, ns + half, 'right'))
+
+    def _running_sum(self, x, lo, hi):
+        '''
+        return the sum of each row of `x` over the windows [lo, hi)
+        '''
+
+        total = np.zeros(x.shape[:-1] + (x.shape[-1] + 1,))
+        np.cumsum(x, axis = -1, out = total[..., 1:])
+        return total[..., hi] - total[..., lo]
+
+    def _rolling_moments(self, data, valid, lo, hi, count, how):
+        '''
+        rolling mean, standard deviation or count of each row of `data`
+
+        The running sums are taken a block of samples at a time, about the
+        mean of the block, so that they stay small.  Variances whose sums
+        may still have lost their precision (a large step inside the
+        block, or a spread near zero) are found again from the windows.
+        '''
+
+        if (how == 'count'):
+            return count
+        nRows, n = data.shape
+        x = np.where(valid, data, 0.)
+        mean = np.empty((nRows, n))
+        var = np.empty((nRows, n))
+        suspect = np.zeros((nRows, n), dtype = bool)
+        width = int((hi - lo).max()) if n > 0 else 0
+        step = max(1024, 4 * width)
+        eps = np.finfo(np.float64).eps
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            for a in range(0, n, step):
+                b = min(a + step, n)
+                # the samples that the windows of this block cover
+                e0, e1 = lo[a], hi[b - 1]
+                i0, i1 = lo[a:b] - e0, hi[a:b] - e0
+                c = count[:, a:b]
+                anchor = x[:, a:b].sum(axis = -1) / \
+                         valid[:, a:b].sum(axis = -1)
+                anchor = np.nan_to_num(anchor)[:, None]
+                d = x[:, e0:e1] - anchor
+                d[~valid[:, e0:e1]] = 0
+                m = self._running_sum(d, i0, i1) / c
+                mean[:, a:b] = m + anchor
+                if (how == 'mean'):
+                    continue
+                d *= d
+                total = np.zeros((nRows, e1 - e0 + 1))
+                np.cumsum(d, axis = -1, out = total[:, 1:])
+                s2 = total[:, i1] - total[:, i0]
+                var[:, a:b] = s2 / c - m * m
+                # the sums are good to about eps times the running total
+                suspect[:, a:b] = (c > 0) & \
+                    (c * var[:, a:b] <= 1e6 * eps * total[:, i1])
+        if (how == 'mean'):
+            return mean
+
+        rows, cols = np.nonzero(suspect)
+        if (len(rows) > 0):
+            padded = np.full((nRows, n + width), np.nan)
+            padded[:, :n] = np.where(valid, data, np.nan)
+            offsets = np.arange(width)
+            chunk = max(1, (1 << 22) // max(width, 1))
+            for a in range(0, len(rows), chunk):
+                r, i = rows[a:a + chunk], cols[a:a + chunk]
+                index = lo[i, None] + offsets
+                block = padded[r[:, None], index]
+                block[index >= hi[i, None]] = np.nan
+                var[r, i] = np.nanvar(block, axis = -1)
+        return np.sqrt(np.maximum(var, 0))
+
+    def _rolling_median(self, data, valid, lo, hi, count, size = None,
+                        withMad = True):
+        '''
+        rolling median and, if `withMad`, MAD of each row of `data`, found
+        together from one view of each block of windows
+
+        Windows of `size` samples are strided views of the padded data.
+        For odd sizes, the medians of the windows with no masked or missing
+        samples come from scipy.ndimage.median_filter, so only their MAD
+        needs the window contents.  Windows cut short by the mask, the ends
+        or `span` are found ignoring the missing samples.
+        '''
+
+        nRows, n = data.shape
+        median = np.empty((nRows, n))
+        mad = np.empty((nRows, n)) if withMad else None
+        if (n == 0):
+            return median, mad
+        filled = np.where(valid, data, np.nan)
+        if (size is not None):
+            width = size
+            full = count == size
+            # pad so that window i is padded[:, i:i + size]
+            padded = np.full((nRows, n + size), np.nan)
+            padded[:, size // 2:size // 2 + n] = filled
+            s0, s1 = padded.strides
+            windows = stride_tricks.as_strided(
+                padded, shape = (nRows, n, size), strides = (s0, s1, s1))
+        else:
+            width = int((hi - lo).max())
+            full = np.zeros((nRows, n), dtype = bool)
+            padded = np.full((nRows, n + width), np.nan)
+            padded[:, :n] = filled
+            offsets = np.arange(width)
+        # median_filter takes the upper of the two middle values of an even
+        # window, rather than their mean
+        filtered = size is not None and size % 2 == 1
+        if (filtered):
+            median[:] = ndimage.median_filter(np.where(valid, data, 0.),
+                                              size = (1, size),
+                                              mode = 'nearest')
+
+        step = max(1, (1 << 22) // max(width * nRows, 1))
+        with warnings.catch_warnings():
+            # windows with no unmasked samples give NaN, and are masked
+            warnings.simplefilter('ignore', RuntimeWarning)
+            for a in range(0, n, step):
+                b = min(a + step, n)
+                if (size is not None):
+                    block = windows[:, a:b]
+                else:
+                    index = lo[a:b, None] + offsets
+                    block = padded[:, index]
+                    block[:, index >= hi[a:b, None]] = np.nan
+                isFull = full[:, a:b]
+
+                # complete windows have no NaN
+                if (withMad or not filtered):
+                    rows = block[isFull]
+                    if (filtered):
+                        center = median[:, a:b][isFull]
+                    else:
+                        center = np.median(rows, axis = -1,
+                                           overwrite_input = True)
+                        median[:, a:b][isFull] = center
+                    if (withMad):
+                        rows -= center[:, None]
+                        mad[:, a:b][isFull] = np.median(
+                            np.abs(rows, out = rows), axis = -1,
+                            overwrite_input = True)
+
+                # the rest: ignore the NaN
+                rows = block[~isFull]
+                if (len(rows) > 0):
+                    center = self._median_rows(rows)
+                    median[:, a:b][~isFull] = center
+                    if (withMad):
+                        rows -= center[:, None]
+                        mad[:, a:b][~isFull] = \
+                            self._median_rows(np.abs(rows, out = rows))
+        return median, mad
+
+    def _median_rows(self, block):
+        '''
+        median along the last axis, ignoring NaN
+        '''
+
+        if (np.isnan(block).any()):
+            return np.nanmedian(block, axis = -1)
+        return np.median(block, axis = -1)
+
+    def psd(self, nperseg = 256, overlap = 0.5, window = 'hann',
+            maxgap = 0):
+        '''
+        Estimate the power spectral density with Welch's method
+
+        The time stream is split into contiguous segments (see
+        `contiguous_ranges`) in which every channel is unmasked, each
+        segment is cut into overlapping windows of `nperseg` samples, and
+        the periodograms of all the windows are averaged.  The FFTs of all
+        windows of all channels are done in large batches.  The sampling
+        should be even within segments; use `lombscargle` otherwise.
+
+        Parameters
+        ----------
+        nperseg : int, optional
+            the number of samples per window.  Defaults to 256.
+        overlap : float, optional
+            the fraction of each window that overlaps the next.  Defaults
+            to 0.5.
+        window : string, optional
+            'hann' (default), 'hamming' or 'boxcar'
+        maxgap : float, optional
+            the largest step, in seconds, allowed within a segment.  See
+            `contiguous_ranges`.
+
+        Returns
+        -------
+        freq : array
+            the frequencies, in Hz
+        psd : array
+            the one-sided power spectral density, in [value units] ** 2 / Hz,
+            with one row per channel for several channels
+        '''
+
+        freq, power = self._welch(nperseg, overlap, window, maxgap, False)
+        return freq, power.reshape(self.values.shape[:-1] + freq.shape)
+
+    def csd(self, nperseg = 256, overlap = 0.5, window = 'hann',
+            maxgap = 0):
+        '''
+        Estimate the cross spectral densities between all pairs of channels
+        with Welch's method.  To compare two time streams, combine them
+        with `MultiTimeStream.merge` first.  See `psd` for the parameters.
+
+        Returns
+        -------
+        freq : array
+            the frequencies, in Hz
+        csd : array
+            An (nChannels, nChannels, nFreq) complex array.  csd[i, j] is
+            the one-sided cross spectral density of channels i and j, and
+            csd[i, i] is the power spectral density of channel i.
+        '''
+
+        return self._welch(nperseg, overlap, window, maxgap, True)
+
+    def _welch(self, nperseg, overlap, window, maxgap, cross):
+        '''
+        average the (cross-)periodograms of the windows of every contiguous
+        segment
+        '''
+
+        ns = self._ns()
+        data = np.ma.getdata(self.values).reshape((-1, len(ns)))
+        nRows = len(data)
+        valid = ~np.ma.getmaskarray(self.values).reshape(data.shape)
+        ranges = self._segments(valid.all(axis = 0), nperseg, maxgap)
+        if (len(ranges) == 0):
+            raise ValueError('No contiguous segment has %d samples' %nperseg)
+        step = max(1, int(round(nperseg * (1 - overlap))))
+        starts = np.concatenate([np.arange(a, b - nperseg + 1, step)
+                                 for a, b in ranges])
+        # the mean sample spacing within the segments
+        spacing = float((ns[ranges[:, 1] - 1] - ns[ranges[:, 0]]).sum()) / \
+                  (ranges[:, 1] - ranges[:, 0] - 1).sum()
+        fs = NS_PER_SECOND / spacing
+        w = _window(window, nperseg)
+
+        nFreq = nperseg // 2 + 1
+        if (cross):
+            total = np.zeros((nRows, nRows, nFreq), dtype = np.complex128)
+        else:
+            total = np.zeros((nRows, nFreq))
+        batch = max(1, (1 << 22) // (nRows * nperseg))
+        offsets = np.arange(nperseg)
+        for i in range(0, len(starts), batch):
+            block = data[:, starts[i:i + batch, None] + offsets]
+            block = block - block.mean(axis = -1)[..., None]
+            block *= w
+            spectra = np.fft.rfft(block, axis = -1)
+            if (cross):
+                total += np.einsum('iwf,jwf->ijf', spectra.conj(), spectra)
+            else:
+                total += (spectra.real ** 2 + spectra.imag ** 2).sum(axis = 1)
+
+        # one-sided density: double everything but DC and Nyquist
+        scale = np.full(nFreq, 2. / (fs * (w * w).sum() * len(starts)))
+        scale[0] /= 2
+        if (nperseg % 2 == 0):
+            scale[-1] /= 2
+        return np.fft.rfftfreq(nperseg, 1. / fs), total * scale
+
+    def lombscargle(self, freq = None, oversample = 4):
+        '''
+        Compute the Lomb-Scargle periodogram, for unevenly sampled data
+
+        Each channel uses its own unmasked samples, with their mean
+        removed.
+
+        Parameters
+        ----------
+        freq : array-like, optional
+            The frequencies, in Hz.  Defaults to a grid from 1 / T to
+            half the mean sampling rate, in steps of 1 / (`oversample` T),
+            where T is the length of the time stream.
+        oversample : float, optional
+            the oversampling of the default frequency grid.  Defaults to 4.
+
+        Returns
+        -------
+        freq : array
+            the frequencies, in Hz
+        power : array
+            the periodogram, as returned by scipy.signal.lombscargle, with
+            one row per channel for several channels
+        '''
+
+        ns = self._ns()
+        used = ns[~np.ma.getmaskarray(self.t)]
+        # seconds from the first sample, to keep precision
+        t = (ns - used[0]) / float(NS_PER_SECOND) if len(used) > 0 else \
+            np.zeros(0)
+        if (freq is None):
+            span = (used[-1] - used[0]) / float(NS_PER_SECOND) \
+                   if len(used) > 1 else 0
+            if (span <= 0):
+                raise ValueError('Need at least two unmasked samples')
+            fMax = 0.5 * (len(used) - 1) / span
+            freq = np.arange(1. / span, fMax, 1. / (oversample * span))
+        freq = np.asarray(freq, dtype = np.float64)
+
+        data = np.ma.getdata(self.values).reshape((-1, len(ns)))
+        valid = ~np.ma.getmaskarray(self.values).reshape(data.shape)
+        power = np.zeros((len(data), len(freq)))
+        for i in range(len(data)):
+            x = data[i][valid[i]].astype(np.float64)
+            if (len(x) > 1):
+                power[i] = signal.lombscargle(t[valid[i]], x - x.mean(),
+                                              2 * np.pi * freq)
+        return freq, power.reshape(self.values.shape[:-1] + freq.shape)
+
+    def align(self, other, tolerance = None, method = 'nearest',
+              offset = 0):
+        '''
+        Match the samples of another time stream to the times of this one
+
+        Masked samples of `other` are ignored.  Both time streams must have
+        sorted times.
+
+        Parameters
+        ----------
+        other : TimeStream
+            the time stream to align
+        tolerance : float, optional
+            The largest distance, in seconds, between a time of this time
+            stream and a sample of `other` used for it.  Times with no
+            sample of `other` close enough are masked.  Defaults to no
+            limit.
+        method : string, optional
+            How to pick the value of `other` at each time:
+            * 'nearest': the closest sample (default)
+            * 'previous': the latest sample at or before the time
+            * 'linear': linear interpolation between the samples on either
+              side
+        offset : float, optional
+            seconds to add to the times of `other` before matching, to
+            correct for an offset between the two clocks
+
+        Returns
+        -------
+        A new time stream of the same kind as `other`, holding the values
+        of `other` at the times of this time stream
+        '''
+
+        target = self._ns() - int(round(offset * NS_PER_SECOND))
+        res = other._lookup(target, method, tolerance)
+        return other._like(res, np.ma.getdata(self.t))
+
+    def _lookup(self, target, method, tolerance = None, maxgap = None):
+        '''
+        return a masked array of the values at the times `target` (in
+        nanoseconds), found by `method` ('nearest', 'previous' or
+        'linear') from the unmasked samples within `tolerance` seconds.
+        For 'linear', points between samples more than `maxgap` seconds
+        apart are masked as well.
+        '''
+
+        if (method not in ('nearest', 'previous', 'linear')):
+            raise ValueError('Unknown method %s' %method)
+        ns = self._ns()
+        data = np.ma.getdata(self.values)
+        n = len(ns)
+        if (n == 0):
+            return np.ma.masked_all(data.shape[:-1] + target.shape)
+
+        # for each target, the last unmasked sample before it and the first
+        # unmasked sample at or after it, in every channel
+        valid = ~np.ma.getmaskarray(self.values)
+        i = np.searchsorted(ns, target)
+        left = np.where(valid, np.arange(n), -1)
+        np.maximum.accumulate(left, axis = -1, out = left)
+        left = np.concatenate((np.full(left.shape[:-1] + (1,), -1), left),
+                              axis = -1)[..., i]
+        right = np.where(valid, np.arange(n), n)[..., ::-1]
+        right = np.minimum.accumulate(right, axis = -1)[..., ::-1]
+        right = np.concatenate((right, np.full(right.shape[:-1] + (1,), n)),
+                               axis = -1)[..., i]
+        hasLeft = left >= 0
+        hasRight = right < n
+        left = np.maximum(left, 0)
+        right = np.minimum(right, n - 1)
+        toLeft = target - ns[left]
+        toRight = ns[right] - target
+        exact = hasRight & (toRight == 0)
+
+        if (method == 'previous'):
+            found = exact | hasLeft
+            use = np.where(exact, right, left)
+            res = np.take_along_axis(data, use, axis = -1)
+            distance = np.where(exact, 0, toLeft)
+        elif (method == 'nearest'):
+            found = hasLeft | hasRight
+            useRight = hasRight & (~hasLeft | (toRight < toLeft))
+            use = np.where(useRight, right, left)
+            res = np.take_along_axis(data, use, axis = -1)
+            distance = np.where(useRight, toRight, toLeft)
+        else:
+            found = exact | (hasLeft & hasRight)
+            vLeft = np.take_along_axis(data, left, axis = -1)
+            vRight = np.take_along_axis(data, right, axis = -1)
+            span = toLeft + toRight
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                w = toLeft / span.astype(np.float64)
+                res = np.where(exact, vRight, vLeft + w * (vRight - vLeft))
+            distance = np.where(exact, 0, np.maximum(toLeft, toRight))
+            if (maxgap is not None):
+                found &= exact | (span <= maxgap * NS_PER_SECOND)
+
+        if (tolerance is not None):
+            found &= distance <= tolerance * NS_PER_SECOND
+        return np.ma.array(res, mask = ~found)
+
+    def contiguous_ranges(self, minsize = 0, maxgap = 0):
+        '''
+        Find the contiguous segments of the time stream
+
+        A segment is a run of unmasked samples in which no two consecutive
+        samples are more than `maxgap` apart.  The times must be sorted.
+
+        Parameters
+        ----------
+        minsize : int, optional
+            the minimum number of samples in a segment.  Shorter segments
+            are dropped.  Defaults to 0.
+        maxgap : float, optional
+            the largest time step, in seconds, allowed within a segment.
+            If 0 (default), any step more than 1.5 times the median step
+            ends a segment.
+
+        Returns
+        -------
+        ranges : array
+            An (n, 2) integer array of [start, stop) sample indices, one
+            row per segment.
+        '''
+
+        return self._segments(~np.ma.getmaskarray(self.t), minsize, maxgap)
+
+    def _segments(self, valid, minsize, maxgap):
+        '''
+        contiguous_ranges, for the samples where `valid` is True
+        '''
+
+        ns = self._ns()
+        if (len(ns) == 0):
+            return np.zeros((0, 2), dtype = np.intp)
+        step = np.diff(ns)
+        if (maxgap <= 0):
+            maxgap = 1.5 * np.median(step) if len(step) > 0 else 0
+        else:
+            maxgap = maxgap * NS_PER_SECOND
+        # joined[i] is True if samples i and i + 1 are in the same segment
+        joined = valid[:-1] & valid[1:] & (step <= maxgap)
+        first = valid.copy()
+        first[1:] &= ~joined
+        last = valid.copy()
+        last[:-1] &= ~joined
+        ranges = np.column_stack((np.flatnonzero(first),
+                                  np.flatnonzero(last) + 1))
+        return ranges[ranges[:, 1] - ranges[:, 0] >= minsize]
+
+    def iter_contiguous(self, minsize = 0, maxgap = 0):
+        '''
+        Iterate over the contiguous segments of the time stream, yielding
+        each as a TimeStream that shares memory with this one.  See
+        `contiguous_ranges` for the parameters.
+        '''
+
+        for start, stop in self.contiguous_ranges(minsize, maxgap):
+            yield self._like(self.values[..., start:stop],
+                             np.ma.getdata(self.t)[start:stop])
 
     def get_contiguous(self, minsize = 0, maxgap = 0):
         """
-        return a list of arrays, each of which contains contiguous
-        samples
+        return a list of TimeStreams, each of which contains contiguous
+        samples.  See `contiguous_ranges` for the parameters.
         """
-        
 
-    def get_time(self):
+        return list(self.iter_contiguous(minsize, maxgap))
+
+    def get_time(self, timeType = None):
         '''
-        return the time as a vector of datetime objects
+        return the time vector
+
+        Parameters
+        ----------
+        timeType : string, optional
+            The time standard to return.  If None (default), the times are
+            returned as a masked array of numpy.datetime64.  If
+            'datetime', they are returned as a masked array of
+            datetime.datetime objects, to the microsecond.  Otherwise, a
+            float array in the requested format is returned.
         '''
-        return self.t
+
+        if (timeType is None):
+            return self.t
+        timeType = timeType.lower()
+        self._check_time_type(timeType)
+        if (timeType == 'datetime'):
+            # datetime64[ns] converts to integers, not datetimes
+            return self.t.astype('datetime64[us]').astype(object)
+        return self._from_ns(timeType)
 
     def get_unixtime(self):
         '''
         return a vector in the unix format (seconds since the eopch)
         '''
-        
-        epoch = dt.datetime(1970, 1, 1, 0, 0, 0, 0)
-        t = np.zeros(np.shape(self.t))
-        i = 0
-        for tmp in self.t:
-            delta = tmp - epoch
-            t[i] = delta.total_seconds()
-            i += 1
-        return t
+
+        return self._from_ns('unix')
 
     def get_matlabtime(self):
         '''
         return a vector in the matlab format (days since 12/31/-0001)
         '''
-        
-        # more hackery here, see above
-        t = np.zeros(np.shape(self.t))
-        i = 0
-        for tmp in self.t:
-            t[i] = tmp.toordinal() + 366 + tmp.hours / 24 + \
-                   tmp.minutes / (60 * 24) + tmp.seconds / (60 * 60 * 24) + \
-                   tmp.microsecond / (1e6 * 60 * 60 * 24)
-        return t
+
+        return self._from_ns('matlab')
 
     def get_labviewtime(self):
         '''
@@ -113,45 +1293,269 @@ class TimeStream:
         (seconds since 1/1/1904 00:00:00)
         '''
 
-        epoch = dt.datetime(1904, 1, 1, 0, 0, 0, 0)
-        t = np.zeros(np.shape(self.t))
-        i = 0
-        for tmp in self.t:
-            delta = tmp - epoch
-            t[i] = delta.total_seconds()
-            i += 1
-        return t
+        return self._from_ns('labview')
 
-    def remove(self, ind):
+    def remove(self, ind = None, intervals = None, timeType = None,
+               compact = True):
         '''
-        remove data points given by ind
+        remove data points given by ind and/or intervals
+
+        The points are masked, and then, if `compact` is set, all masked
+        points are dropped from the time stream.  When cleaning in several
+        steps, pass compact = False to each step and call `compact` once
+        at the end to avoid copying the data at every step.
 
         Parameters
         ----------
-        ind : array-like
-            an array of indices to remove
+        ind : array-like, optional
+            an array of sample indices to remove, or a boolean array that is
+            True for the points to remove.  A boolean array with the shape
+            of the values masks individual channels.
+        intervals : array-like, optional
+            a sequence of (start, stop) pairs.  Points with
+            start <= t < stop are removed.  The times must be sorted.
+        timeType : string, optional
+            the time standard of `intervals`.  If None, they are interpreted
+            by numpy.datetime64.
+        compact : bool, optional
+            If True (default), drop the masked points.  Otherwise, only mask
+            them.
         '''
-        
-        for i in np.atleast_1d(ind):
-            self.t[i] = np.ma.mask
-            self.values[i] = np.ma.mask
-        self.t = self.t[~self.t.mask]
-        self.values = self.values[~self.values.mask]
-
-    def plot(self, ax = None, locator_args = None):
-        if (ax == None):
+
+        n = len(self.t)
+        drop = np.zeros(n, dtype = bool)
+        if (ind is not None):
+            ind = np.asarray(ind)
+            if (ind.dtype == bool):
+                drop = drop | ind
+            else:
+                # an empty list is float, so cast before indexing
+                drop[ind.astype(np.intp)] = True
+        if (intervals is not None and len(intervals) > 0):
+            ns = self._ns()
+            bounds = self._time_arg(intervals, timeType).reshape((-1, 2))
+            bounds = np.searchsorted(ns, bounds)
+            # +1 at each start and -1 at each stop: the running sum is
+            # positive inside any interval
+            inside = np.zeros(n + 1, dtype = np.intp)
+            np.add.at(inside, bounds[:, 0], 1)
+            np.add.at(inside, bounds[:, 1], -1)
+            drop |= np.cumsum(inside[:-1]) > 0
+
+        self.values.mask = np.ma.getmaskarray(self.values) | drop
+        self.t.mask = _sample_mask(self.values)
+        if (compact):
+            self.compact()
+
+    def compact(self):
+        '''
+        drop all data points for which every channel is masked
+        '''
+
+        keep = ~np.ma.getmaskarray(self.t)
+        if (not keep.all()):
+            self.t = self.t[keep]
+            self.values = self.values[..., keep]
+
+    def append(self, values, t, timeType = None, mask = np.ma.nomask):
+        '''
+        Add samples to the end of the time stream
+
+        The samples are stored in buffers that double in size when they
+        fill up, so appending is amortized O(1) and the time stream stays
+        a view of the buffers.  New times should not be earlier than the
+        existing ones.
+
+        Parameters
+        ----------
+        values : array-like
+            the new values, with samples along the last axis
+        t : array-like
+            the times of the new samples
+        timeType : string, optional
+            the time standard of `t`.  If None, it is interpreted by
+            numpy.datetime64.
+        mask : array-like, optional
+            the mask of the new values
+        '''
+
+        t = np.atleast_1d(self._time_arg(t, timeType))
+        values = np.ma.array(values, mask = mask)
+        values = values.reshape(self.values.shape[:-1] + t.shape)
+        if (not self._buffered() or
+            np.result_type(self._vBuf, values) != self._vBuf.dtype):
+            self._rebuffer(np.result_type(self.values, values), len(t))
+
+        # drop whatever would fall out of the ring after this append
+        if (self._span is not None and len(t) > 0):
+            first = np.searchsorted(t, t[-1] - self._span)
+            t = t[first:]
+            values = values[..., first:]
+        if (self._maxlen is not None and len(t) > self._maxlen):
+            t = t[-self._maxlen:]
+            values = values[..., -self._maxlen:]
+        k = len(t)
+        self._trim(t[-1] if k > 0 else None, k)
+
+        if (self._stop + k > len(self._tBuf)):
+            live = self._stop - self._start
+            capacity = len(self._tBuf)
+            if (2 * (live + k) > capacity):
+                capacity = 2 * (live + k)
+            self._move(capacity)
+        new = slice(self._stop, self._stop + k)
+        self._tBuf[new] = t
+        self._vBuf[..., new] = np.ma.getdata(values)
+        self._mBuf[..., new] = np.ma.getmaskarray(values)
+        self._stop += k
+        self._attach()
+
+    def set_ring(self, span = None, maxlen = None):
+        '''
+        Make the time stream a ring buffer for live data
+
+        After this, `append` keeps only the most recent samples.  Memory is
+        allocated once the ring is full, and the time stream stays a view
+        of its buffers.
+
+        Parameters
+        ----------
+        span : float, optional
+            keep only the samples within `span` seconds of the latest one
+        maxlen : int, optional
+            keep at most `maxlen` samples
+        '''
+
+        self._span = None if span is None else int(round(span * NS_PER_SECOND))
+        self._maxlen = maxlen
+        if (not self._buffered()):
+            self._rebuffer(self.values.dtype, 0)
+        self._trim(self._tBuf[self._stop - 1] if self._stop > self._start
+                   else None, 0)
+        self._attach()
+
+    def _buffered(self):
+        '''
+        return True if the time stream is still a view of its append
+        buffers
+        '''
+
+        return self._tBuf is not None and self.values is self._attached
+
+    def _rebuffer(self, dtype, extra):
+        '''
+        copy the time stream into new append buffers with room for `extra`
+        more samples
+        '''
+
+        n = len(self.t)
+        shape = self.values.shape[:-1]
+        capacity = max(16, 2 * (n + extra))
+        self._tBuf = np.empty(capacity, dtype = np.int64)
+        self._vBuf = np.empty(shape + (capacity,), dtype = dtype)
+        self._mBuf = np.zeros(shape + (capacity,), dtype = bool)
+        self._tBuf[:n] = self._ns()
+        self._vBuf[..., :n] = np.ma.getdata(self.values)
+        self._mBuf[..., :n] = np.ma.getmaskarray(self.values)
+        self._start, self._stop = 0, n
+
+    def _trim(self, last, k):
+        '''
+        drop the buffered samples that would fall out of the ring if `k`
+        samples ending at time `last` were appended
+        '''
+
+        start, stop = self._start, self._stop
+        if (self._span is not None and last is not None):
+            start += np.searchsorted(self._tBuf[start:stop], last - self._span)
+        if (self._maxlen is not None):
+            start = max(start, stop + k - self._maxlen)
+        self._start = min(start, stop)
+
+    def _move(self, capacity):
+        '''
+        move the buffered samples to the front of buffers of length
+        `capacity`
+        '''
+
+        live = slice(self._start, self._stop)
+        n = self._stop - self._start
+        for name in ('_tBuf', '_vBuf', '_mBuf'):
+            old = getattr(self, name)
+            new = old
+            if (capacity != old.shape[-1]):
+                new = np.zeros(old.shape[:-1] + (capacity,), dtype = old.dtype)
+                setattr(self, name, new)
+            new[..., :n] = old[..., live]
+        self._start, self._stop = 0, n
+
+    def _attach(self):
+        '''
+        point the values and times at the live part of the buffers
+        '''
+
+        live = slice(self._start, self._stop)
+        self.values = np.ma.array(self._vBuf[..., live],
+                                  mask = self._mBuf[..., live], copy = False)
+        # write masking through to the buffer rather than copying the mask
+        self.values._sharedmask = False
+        self.t = np.ma.array(self._tBuf[live].view('datetime64[ns]'),
+                             mask = _sample_mask(self.values), copy = False)
+        self._attached = self.values
+
+    def plot(self, ax = None, locator_args = None, fmt = '.',
+             decimate = True, pixels = None):
+        '''
+        plot the time stream (every channel) against time
+
+        Parameters
+        ----------
+        ax : matplotlib.axes.Axes, optional
+            the axes to plot on.  Defaults to a new figure.
+        locator_args : dict, optional
+            keyword arguments for the matplotlib.dates.AutoDateLocator
+        fmt : string, optional
+            the matplotlib format string.  Defaults to '.'
+        decimate : bool, optional
+            If True (default), only the minimum and maximum of the samples
+            falling in each pixel of the visible range are drawn, so that
+            spikes stay visible.  The decimation is redone whenever the
+            x limits change, from a precomputed min/max pyramid.
+        pixels : int, optional
+            the number of pixels across the axes.  Defaults to the width
+            of `ax` on screen.
+
+        Returns
+        -------
+        ax : matplotlib.axes.Axes
+            the axes plotted on
+        '''
+
+        if (ax is None):
             fig = plt.figure()
-            ax = sig.add_subplot(111)
-        ax.plot(self.t, self.values, '.')
+            ax = fig.add_subplot(111)
+        if (decimate and len(self.t) > 0):
+            pyramid = _MinMaxPyramid(self._ns(), self.values, pixels)
+            x, y = pyramid.visible(ax)
+            pyramid.lines = ax.plot(x, y.T, fmt)
+            # a plain function, since matplotlib only keeps weak references
+            # to bound methods
+            ax.callbacks.connect('xlim_changed',
+                                 lambda ax: pyramid.redraw(ax))
+        else:
+            ax.plot(np.ma.getdata(self.t), self.values.T, fmt)
 
         # set tickmarks for dates
+        if (locator_args is None):
+            locator_args = {}
         loc = mdates.AutoDateLocator(**locator_args)
         ax.xaxis.set_major_locator(loc)
         ax.xaxis.set_major_formatter(mdates.AutoDateFormatter(loc))
-        
+        return ax
 
-    def _check_time_type(self, timeType):
-        if (timeType not in TIME_TYPES):
+    @classmethod
+    def _check_time_type(cls, timeType):
+        if (timeType != 'datetime' and timeType not in cls.TIME_TYPES):
             raise ValueError('Time format %s is invalid' %timeType)
 
     def _check_mask(self):
@@ -161,3 +1565,166 @@ class TimeStream:
     def __call__(self):
         return self.values
 
+
+class _MinMaxPyramid(object):
+    """
+    Level of detail for plotting a long time stream
+
+    Level L of the pyramid holds the minimum and maximum of each block of
+    2 ** L samples of every channel, with masked samples ignored.  Only the
+    visible samples of the coarsest level that still has at least one
+    block per pixel are drawn.
+    """
+
+    def __init__(self, ns, values, pixels = None):
+        self.ns = ns
+        self.pixels = pixels
+        self.lines = []
+        data = np.ma.filled(values.astype(np.float64), np.nan)
+        data = data.reshape((-1, len(ns)))
+        self.levels = [(data, data)]
+        low, high = data, data
+        while (low.shape[-1] > 1):
+            if (low.shape[-1] % 2 == 1):
+                pad = np.full((len(low), 1), np.nan)
+                low = np.concatenate((low, pad), axis = -1)
+                high = np.concatenate((high, pad), axis = -1)
+            low = np.fmin(low[:, ::2], low[:, 1::2])
+            high = np.fmax(high[:, ::2], high[:, 1::2])
+            self.levels.append((low, high))
+        # matplotlib date numbers are days, offset from the times
+        self.day0 = mdates.date2num(ns[:1].view('datetime64[ns]'))[0]
+
+    def visible(self, ax):
+        '''
+        return the x and y data to draw for the visible range of `ax`
+        '''
+
+        n = len(self.ns)
+        i0, i1 = 0, n
+        if (ax.lines or ax.collections):
+            x0, x1 = ax.get_xlim()
+            bounds = self.ns[0] + (np.array([x0, x1]) - self.day0) * \
+                     (86400. * NS_PER_SECOND)
+            i0, i1 = np.searchsorted(self.ns, bounds.astype(np.int64))
+            # include a sample on either side so lines reach the edges
+            i0, i1 = max(i0 - 1, 0), min(i1 + 1, n)
+        pixels = self.pixels
+        if (pixels is None):
+            pixels = max(ax.get_window_extent().width, 1)
+        level = 0
+        if (i1 - i0 > 2 * pixels):
+            level = int(np.ceil(np.log2((i1 - i0) / float(pixels))))
+            level = min(level, len(self.levels) - 1)
+
+        low, high = self.levels[level]
+        j0, j1 = i0 >> level, -(-i1 >> level)
+        t = self.ns[np.arange(j0, j1) << level]
+        if (level == 0):
+            y = low[:, j0:j1]
+        else:
+            t = np.repeat(t, 2)
+            y = np.stack((low[:, j0:j1], high[:, j0:j1]), axis = -1)
+            y = y.reshape((len(low), -1))
+        x = self.day0 + (t - self.ns[0]) / (86400. * NS_PER_SECOND)
+        return x, y
+
+    def redraw(self, ax):
+        x, y = self.visible(ax)
+        for line, row in zip(self.lines, y):
+            line.set_data(x, row)
+
+class MultiTimeStream(TimeStream):
+    """
+    Several channels of data sampled at the same times
+
+    The values are a 2-D masked array (channels x samples), with a separate
+    mask for each channel, and a single time vector shared by all channels.
+    Every TimeStream method works on all channels at once.  Indexing with a
+    channel number or name returns that channel as a TimeStream that shares
+    memory with this one.
+    """
+
+    _HEADER_KEYS = ('names',)
+
+    def __init__(self, values, t, timeType, mask = np.ma.nomask,
+                 names = None):
+        TimeStream.__init__(self, values, t, timeType, mask)
+        if (self.values.ndim != 2):
+            raise ValueError('values must be 2-D (channels x samples)')
+        if (names is None):
+            names = range(len(self.values))
+        elif (len(names) != len(self.values)):
+            raise ValueError('There must be one name per channel')
+        self.names = list(names)
+
+    @classmethod
+    def _wrap(cls, values, t):
+        obj = super(MultiTimeStream, cls)._wrap(values, t)
+        obj.names = list(range(len(values)))
+        return obj
+
+    def _like(self, values, t):
+        obj = self._wrap(values, t)
+        obj.names = list(self.names)
+        return obj
+
+    @classmethod
+    def merge(cls, streams, tolerance = None, method = 'nearest',
+              base = None, names = None):
+        '''
+        Combine several time streams onto one time base
+
+        Parameters
+        ----------
+        streams : sequence of TimeStream
+            the time streams to merge.  Each must have sorted times.
+        tolerance, method : optional
+            how to match samples to the time base; see `TimeStream.align`
+        base : TimeStream, optional
+            the time stream whose times to use.  Defaults to the union of
+            the times of all `streams`.
+        names : sequence, optional
+            The names of the channels of the result.  Defaults to the
+            channel names of any MultiTimeStreams in `streams`, and the
+            position in `streams` otherwise.
+
+        Returns
+        -------
+        A MultiTimeStream with the channels of all `streams`, in order
+        '''
+
+        if (base is None):
+            t = np.unique(np.concatenate([s._ns() for s in streams]))
+            base = TimeStream._wrap(np.ma.zeros(len(t)),
+                                    t.view('datetime64[ns]'))
+        aligned = [base.align(s, tolerance, method) for s in streams]
+        values = np.ma.concatenate([a.values.reshape((-1, len(base.t)))
+                                    for a in aligned])
+        if (names is None):
+            names = []
+            for i, s in enumerate(streams):
+                names.extend(getattr(s, 'names', [i]))
+        obj = cls._wrap(values, np.ma.getdata(base.t))
+        obj.names = list(names)
+        return obj
+
+    def channel(self, key):
+        '''
+        return one channel, by number or name, as a TimeStream that shares
+        memory with this one
+        '''
+
+        if (not isinstance(key, (int, np.integer))):
+            key = self.names.index(key)
+        return TimeStream._wrap(self.values[key], np.ma.getdata(self.t))
+
+    def __getitem__(self, key):
+        return self.channel(key)
+
+
+# matlab defines datenum('Jan-1-0000 00:00:00') = 1
+TimeStream.register_time_type('matlab', np.datetime64('-0001-12-31'), 86400)
+TimeStream.register_time_type('labview', '1904-01-01', 1)
+TimeStream.register_time_type('unix', '1970-01-01', 1)
+TimeStream.register_time_type('mjd', '1858-11-17', 86400)
@@ -5,6 +5,9 @@
 ##############################################################################
 from materials import *
 
+# the fit coefficients alpha, Beta, gamma and n of bf.kt
+_CV_COEFF = (12.8e-3, 2.41, -9.21, .222)
+
 def cv(T):
     '''
     Thermal conductivity in W / m K
@@ -18,8 +21,16 @@ def cv(T):
     if (np.any(T < .3)):
         print 'Warning: Temperature too low (valid range is .3 to 4.2 K)'
     
-    alpha = 12.8e-3
-    Beta = 2.41
-    gamma = -9.21
-    n = .222
-    return bf.kt(T, alpha, Beta, gamma, n)
+    return bf.kt(T, *_CV_COEFF)
+
+def cv_integral(Tlow, Thigh):
+    '''
+    The integral of the thermal conductivity from `Tlow` to `Thigh`, in
+    W / m.  `Tlow` and `Thigh` broadcast against each other, and must be
+    between .3 and 4.2 K.  The integral is interpolated from a precomputed
+    table.
+    '''
+
+    T, table = bf.integral_table(lambda T: bf.kt(T, *_CV_COEFF), .3, 4.2,
+                                 ('G10', _CV_COEFF))
+    return bf.table_interp(T, table, Thigh) - bf.table_interp(T, table, Tlow)
@@ -4,6 +4,7 @@
 # Functions for generating material properties                               #
 ##############################################################################
 import numpy as np
+import hashlib, os
 
 def kt(T, alpha, Beta, gamma, n):
     '''
@@ -40,3 +41,63 @@ def NIST_10(T, coeff):
         tmp += c * logprod
         logprod *= logT
     return 10 ** tmp
+
+# conductivity integral tables, by key, and the directory they are saved in
+_tables = {}
+TABLE_DIR = os.environ.get('MATERIALS_TABLE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache',
+                                        'materials'))
+
+def integral_table(k, Tmin, Tmax, key, n = 2000):
+    '''
+    The cumulative integral of the conductivity `k(T)` from `Tmin`, on `n`
+    log-spaced temperatures up to `Tmax`.  Returns (T, integral).
+
+    Each step is integrated with Simpson's rule.  The table is kept in
+    memory and saved in TABLE_DIR, under a hash of `key`, `Tmin`, `Tmax`
+    and `n`.  `key` must identify the coefficients of `k`, so that a
+    table is rebuilt when they change.
+    '''
+    name = hashlib.sha1(repr((key, Tmin, Tmax, n))).hexdigest()
+    if (name in _tables):
+        return _tables[name]
+
+    path = os.path.join(TABLE_DIR, name + '.npy')
+    try:
+        table = np.load(path)
+    except (IOError, ValueError):
+        T = np.logspace(np.log10(Tmin), np.log10(Tmax), n)
+        # logspace can miss the ends by a rounding error, which would put
+        # them outside the valid range of `k`
+        T[0], T[-1] = Tmin, Tmax
+        mid = (T[1:] + T[:-1]) / 2
+        kT = k(T)
+        steps = (T[1:] - T[:-1]) / 6 * (kT[:-1] + 4 * k(mid) + kT[1:])
+        table = np.array([T, np.concatenate([[0], np.cumsum(steps)])])
+        try:
+            if (not os.path.isdir(TABLE_DIR)):
+                os.makedirs(TABLE_DIR)
+            # write, then rename, so readers never see part of a table
+            tmp = '%s.%d.tmp.npy' %(path[:-4], os.getpid())
+            np.save(tmp, table)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            pass
+    _tables[name] = table
+    return table
+
+def table_interp(T, table, x, rows = None):
+    '''
+    Linearly interpolate `table` on the grid `T` at `x`.  `table` has one
+    row per curve on the grid; if `rows` is given, it picks the row used
+    for each element of `x`.  Raises ValueError outside the grid.
+    '''
+    x = np.asarray(x, dtype = float)
+    if (np.any(x < T[0]) or np.any(x > T[-1])):
+        raise ValueError('Temperature out of range (the table covers ' +
+                         '%g to %g K)' %(T[0], T[-1]))
+    i = np.clip(np.searchsorted(T, x), 1, len(T) - 1)
+    w = (x - T[i - 1]) / (T[i] - T[i - 1])
+    if (rows is None):
+        return (1 - w) * table[i - 1] + w * table[i]
+    return (1 - w) * table[rows, i - 1] + w * table[rows, i]
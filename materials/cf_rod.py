@@ -5,6 +5,9 @@
 ##############################################################################
 from materials import *
 
+# the fit coefficients alpha, Beta, gamma and n of bf.kt
+_CV_COEFF = (8.39e-3, 2.12, -1.05, .181)
+
 def cv(T):
     '''
     Thermal conductivity paralell to fibers
@@ -18,8 +21,16 @@ def cv(T):
     if (np.any(T < .3)):
         print 'Warning: Temperature too low (valid range is .3 to 4.2 K)'
     
-    alpha = 8.39e-3
-    Beta = 2.12
-    gamma = -1.05
-    n = .181
-    return bf.kt(T, alpha, Beta, gamma, n)
+    return bf.kt(T, *_CV_COEFF)
+
+def cv_integral(Tlow, Thigh):
+    '''
+    The integral of the thermal conductivity from `Tlow` to `Thigh`, in
+    W / m.  `Tlow` and `Thigh` broadcast against each other, and must be
+    between .3 and 4.2 K.  The integral is interpolated from a precomputed
+    table.
+    '''
+
+    T, table = bf.integral_table(lambda T: bf.kt(T, *_CV_COEFF), .3, 4.2,
+                                 ('cf_rod', _CV_COEFF))
+    return bf.table_interp(T, table, Thigh) - bf.table_interp(T, table, Tlow)
@@ -5,54 +5,111 @@
 ##############################################################################
 from materials import *
 
+# the RRR values of the NIST fits, and their coefficients, one row per RRR
+RRRS = np.array([50, 100, 150, 300, 500])
+_CV_COEFF = np.array([[1.87430000e+00, -4.15380000e-01, -6.01800000e-01,
+                       1.32940000e-01, 2.64260000e-01, -2.19000000e-02,
+                       -5.12760000e-02, 1.48710000e-03, 3.72300000e-03],
+                      [2.21540000e+00, -4.74610000e-01, -8.80680000e-01,
+                       1.38710000e-01, 2.95050000e-01, -2.04300000e-02,
+                       -4.83100000e-02, 1.28100000e-03, 3.20700000e-03],
+                      [2.37970000e+00, -4.91800000e-01, -9.86150000e-01,
+                       1.39420000e-01, 3.04750000e-01, -1.97130000e-02,
+                       -4.68970000e-02, 1.19690000e-03, 2.99880000e-03],
+                      [1.35700000e+00, 3.98100000e-01, 2.66900000e+00,
+                       -1.34600000e-01, -6.68300000e-01, 1.34200000e-02,
+                       5.77300000e-02, 2.14700000e-04, 0.00000000e+00],
+                      [2.80750000e+00, -5.40740000e-01, -1.27770000e+00,
+                       1.53620000e-01, 3.64440000e-01, -2.10500000e-02,
+                       -5.17270000e-02, 1.22260000e-03, 3.09640000e-03]])
+
+# below Tpiv, the conductivity is extrapolated linearly to 0
+Tpiv = 4.2
+# the conductivity of each RRR curve at Tpiv
+_CV_PIVOT = bf.NIST_cu(Tpiv, *_CV_COEFF.T)
+
 def cv(T, rrr = 100):
     '''
     Thermal conductivity in W / m K
+
+    `T` and `rrr` broadcast against each other.  The conductivity is
+    interpolated linearly between the two NIST curves that bracket `rrr`,
+    which must be between 50 and 500.
+
+    >>> k = cv([10, 20], [[50, 500], [100, 300]])
+    >>> k.shape
+    (2, 2)
+    >>> np.allclose(k, [[cv(10, 50), cv(20, 500)], [cv(10, 100), cv(20, 300)]])
+    True
     '''
 
-    if (not isinstance(T, np.ndarray)):
-        T = np.array(T)
-        
-    rrrs = [50, 100, 150, 300, 500]
+    T = np.asarray(T, dtype = float)
+    rrr = np.asarray(rrr, dtype = float)
     if (np.any(T > 300)):
         print 'Warning: Temperature too high (valid range is below 300 K)'
-    a = np.zeros((9, 5))
-    try:
-        k = np.zeros((len(T), 5))
-    except TypeError:
-        k = np.zeros((1, 5))
-    a[:, 0] = np.array([1.87430000e+00, -4.15380000e-01, -6.01800000e-01,
-                        1.32940000e-01, 2.64260000e-01, -2.19000000e-02,
-                        -5.12760000e-02, 1.48710000e-03, 3.72300000e-03])
-    a[:, 1] = np.array([2.21540000e+00, -4.74610000e-01, -8.80680000e-01,
-                        1.38710000e-01, 2.95050000e-01, -2.04300000e-02,
-                        -4.83100000e-02, 1.28100000e-03, 3.20700000e-03])
-    a[:, 2] = np.array([2.37970000e+00, -4.91800000e-01, -9.86150000e-01,
-                        1.39420000e-01, 3.04750000e-01, -1.97130000e-02,
-                        -4.68970000e-02, 1.19690000e-03, 2.99880000e-03])
-    a[:, 3] = np.array([1.35700000e+00, 3.98100000e-01, 2.66900000e+00,
-                        -1.34600000e-01, -6.68300000e-01, 1.34200000e-02,
-                        5.77300000e-02, 2.14700000e-04, 0.00000000e+00])
-    a[:, 4] = np.array([2.80750000e+00, -5.40740000e-01, -1.27770000e+00,
-                        1.53620000e-01, 3.64440000e-01, -2.10500000e-02,
-                        -5.17270000e-02, 1.22260000e-03, 3.09640000e-03])
-    
-    for i in range(len(a[0])):
-        # generate conductivity for each purity level
-        k[:, i] = bf.NIST_cu(T, *a[:, i])
+    if (np.any(rrr < RRRS[0]) or np.any(rrr > RRRS[-1])):
+        raise ValueError('rrr must be between %d and %d'
+                         %(RRRS[0], RRRS[-1]))
+
+    # the bracketing curves, and the weight of the upper one
+    i = np.clip(np.searchsorted(RRRS, rrr, side = 'right') - 1,
+                0, len(RRRS) - 2)
+    w = (rrr - RRRS[i]) / (RRRS[i + 1] - RRRS[i])
 
-    # now, interpolate to desired purity
-    fk = interpolate.interp1d(rrrs, k)
-    k = fk(rrr)
+    # evaluate the two curves only, above the pivot
+    Tfit = np.maximum(T, Tpiv)
+    # the coefficients are the last axis of _CV_COEFF[i]
+    lower = np.moveaxis(_CV_COEFF[i], -1, 0)
+    upper = np.moveaxis(_CV_COEFF[i + 1], -1, 0)
+    k = (1 - w) * bf.NIST_cu(Tfit, *lower) + w * bf.NIST_cu(Tfit, *upper)
 
     # extrapolate linearly to lower temperatures
-    Tpiv = 4.2
-    ind = np.where(T < Tpiv)
-    if len(ind) > 0:
-        kpiv = cv(Tpiv, rrr)
-        k[ind] = kpiv * T[ind] / Tpiv
+    kpiv = (1 - w) * _CV_PIVOT[i] + w * _CV_PIVOT[i + 1]
+    return np.where(T < Tpiv, kpiv * T / Tpiv, k)
+
+# the temperatures and the stacked integral tables of the NIST curves,
+# built by _cv_tables
+_CV_TABLES = None
+
+def _cv_tables():
+    '''
+    return the temperatures and the integral table of each NIST curve,
+    one row per RRR
+    '''
+    global _CV_TABLES
+    if (_CV_TABLES is None):
+        tables = []
+        for rrrCurve, coeff in zip(RRRS, _CV_COEFF):
+            T, table = bf.integral_table(lambda T, r = rrrCurve: cv(T, r),
+                                         .01, 300,
+                                         ('copper', tuple(coeff), Tpiv))
+            tables.append(table)
+        _CV_TABLES = T, np.array(tables)
+    return _CV_TABLES
+
+def cv_integral(Tlow, Thigh, rrr = 100):
+    '''
+    The integral of the thermal conductivity from `Tlow` to `Thigh`, in
+    W / m.  `Tlow`, `Thigh` and `rrr` broadcast against each other.  The
+    temperatures must be between .01 and 300 K.
+
+    The integral of each NIST curve is interpolated from a precomputed
+    table, and the two curves that bracket `rrr` are blended as in `cv`.
+    '''
+
+    rrr = np.asarray(rrr, dtype = float)
+    if (np.any(rrr < RRRS[0]) or np.any(rrr > RRRS[-1])):
+        raise ValueError('rrr must be between %d and %d'
+                         %(RRRS[0], RRRS[-1]))
+    T, tables = _cv_tables()
 
-    return k
+    Tlow, Thigh, rrr = np.broadcast_arrays(Tlow, Thigh, rrr)
+    i = np.clip(np.searchsorted(RRRS, rrr, side = 'right') - 1,
+                0, len(RRRS) - 2)
+    w = (rrr - RRRS[i]) / (RRRS[i + 1] - RRRS[i])
+    integral = lambda j: bf.table_interp(T, tables, Thigh, j) - \
+                         bf.table_interp(T, tables, Tlow, j)
+    return (1 - w) * integral(i) + w * integral(i + 1)
 
 def c(T):
     '''